@@ -0,0 +1,50 @@
+import asyncio
+
+from collections import deque
+
+import metrics
+
+async def _aiter(items):
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+async def ordered_map(func, items, workers, window=None):
+    # Like map(), but awaits up to `workers` calls to `func` at once. Results are yielded in the same order
+    # as `items`, and no more than `window` items are in flight or waiting to be yielded at any time.
+    # `items` may be an async iterable, e.g. another ordered_map, to chain stages that overlap in time.
+    window = window or 4 * workers
+    assert window >= workers
+
+    sem = asyncio.Semaphore(workers)
+    queue = getattr(func, '__name__', 'ordered_map')
+    running = 0
+
+    async def run(item):
+        nonlocal running
+        async with sem:
+            running += 1
+            metrics.set_gauge('queue_running', running, queue=queue)
+            try:
+                return await func(item)
+            finally:
+                running -= 1
+                metrics.set_gauge('queue_running', running, queue=queue)
+
+    pending = deque()
+    try:
+        async for item in _aiter(items):
+            pending.append(asyncio.ensure_future(run(item)))
+            metrics.set_gauge('queue_pending', len(pending), queue=queue)
+            if len(pending) >= window:
+                yield await pending.popleft()
+        while pending:
+            metrics.set_gauge('queue_pending', len(pending), queue=queue)
+            yield await pending.popleft()
+        metrics.set_gauge('queue_pending', 0, queue=queue)
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# Offline benchmarks for the scraping and merging hot paths, with regression checks against a saved baseline
+#
+#   benchmark.py build intermediate/stage2.*.csv     # render a corpus of pages from our own data
+#   benchmark.py run --save-baseline baseline.json   # on the base revision
+#   benchmark.py run --baseline baseline.json        # on your change; exits 1 on a regression
+
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from glob import glob
+
+import stage3
+
+from async_utils import ordered_map
+from gva_pages import RESULTS_PER_PAGE, iter_stage2_rows, render_incident_page, render_query_page
+from http_cache import ResponseCache
+from mock_server import MockGVA, start_server
+from stage1_serializer import GVA_DOMAIN, PARSERS, Stage1Serializer
+from stage2_extractor import EXTRACTORS
+from stage2_session import Context, Stage2Session
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-c', '--corpus',
+        metavar='DIR',
+        help="corpus directory (default: bench-corpus)",
+        action='store',
+        dest='corpus_dir',
+        default='bench-corpus',
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help="render incident and query pages from stage2 files into the corpus")
+    build.add_argument(
+        'csv_fnames',
+        metavar='FILE',
+        nargs='+',
+        help="stage2 files to render pages from",
+    )
+    build.add_argument(
+        '-n', '--limit',
+        metavar='NUM',
+        help="render at most NUM incidents from each file (default: 1000)",
+        action='store',
+        dest='limit',
+        type=int,
+        default=1000,
+    )
+
+    run = subparsers.add_parser('run', help="run the benchmarks")
+    run.add_argument(
+        'names',
+        metavar='NAME',
+        nargs='*',
+        help="only run benchmarks whose names start with NAME",
+    )
+    run.add_argument(
+        '-r', '--repeat',
+        metavar='NUM',
+        help="run each benchmark NUM times and keep the best result (default: 3)",
+        action='store',
+        dest='repeat',
+        type=int,
+        default=3,
+    )
+    run.add_argument(
+        '-l', '--limit',
+        metavar='NUM',
+        help="number of simultaneous connections in the session benchmarks (default: 20)",
+        action='store',
+        dest='conn_limit',
+        type=int,
+        default=20,
+    )
+    run.add_argument(
+        '-j', '--jobs',
+        metavar='NUM',
+        help="worker processes for parsing in the session benchmarks (default: 0)",
+        action='store',
+        dest='jobs',
+        type=int,
+        default=0,
+    )
+    run.add_argument(
+        '--latency',
+        metavar='SECONDS',
+        help="average response delay of the local server in the session benchmarks (default: 0.05)",
+        action='store',
+        dest='latency',
+        type=float,
+        default=0.05,
+    )
+    run.add_argument(
+        '--error-rate',
+        metavar='RATE',
+        help="fraction of requests the local server fails with a 500, 502 or 503 (default: 0)",
+        action='store',
+        dest='error_rate',
+        type=float,
+        default=0,
+    )
+    run.add_argument(
+        '--baseline',
+        metavar='FILE',
+        help="compare against results saved with --save-baseline and exit with status 1 on a regression",
+        action='store',
+        dest='baseline_fname',
+    )
+    run.add_argument(
+        '--save-baseline',
+        metavar='FILE',
+        help="save the results to FILE",
+        action='store',
+        dest='save_baseline_fname',
+    )
+    run.add_argument(
+        '--tolerance',
+        metavar='FRACTION',
+        help="how much worse than the baseline a result may be before it counts as a regression (default: 0.1)",
+        action='store',
+        dest='tolerance',
+        type=float,
+        default=0.1,
+    )
+    return parser.parse_args()
+
+INCIDENT_COLUMNS = ['incident_url', 'address', 'city_or_county', 'state']
+
+class Corpus(object):
+    # pages/ is a ResponseCache keyed by gunviolencearchive.org URLs, stage2/ holds the files the pages were
+    # rendered from, and corpus.json lists the stage1 queries and the incidents that have pages.
+    def __init__(self, root):
+        self.root = root
+        self.pages = ResponseCache(os.path.join(root, 'pages'), offline=True)
+        self.stage2_dir = os.path.join(root, 'stage2')
+        self.index_fname = os.path.join(root, 'corpus.json')
+        self._index = None
+
+    def stage2_fnames(self):
+        return sorted(glob(os.path.join(self.stage2_dir, stage3.STAGE2_GLOB)))
+
+    def _load_index(self):
+        if self._index is None:
+            with open(self.index_fname, encoding='utf-8') as index_file:
+                self._index = json.load(index_file)
+        return self._index
+
+    def queries(self):
+        return self._load_index()['queries']
+
+    def incidents(self):
+        return self._load_index()['incidents']
+
+def build(args):
+    corpus = Corpus(args.corpus_dir)
+    os.makedirs(corpus.stage2_dir, exist_ok=True)
+
+    queries, incidents = [], []
+    for csv_fname in args.csv_fnames:
+        shutil.copy(csv_fname, corpus.stage2_dir)
+        rows = list(iter_stage2_rows([csv_fname]))[:args.limit]
+        rows = [row for row in rows if row['incident_url_fields_missing'] != 'True']
+        for row in rows:
+            corpus.pages.put(row['incident_url'], render_incident_page(row))
+            incidents.append({column: row[column] for column in INCIDENT_COLUMNS})
+
+        # One query per file. The site lists results newest first.
+        query_path = '/query/' + os.path.splitext(os.path.basename(csv_fname))[0]
+        rows.reverse()
+        n_pages = (len(rows) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
+        for pageno in range(n_pages):
+            page_rows = rows[pageno * RESULTS_PER_PAGE:(pageno + 1) * RESULTS_PER_PAGE]
+            url = GVA_DOMAIN + query_path + ('?page={}'.format(pageno) if pageno else '')
+            corpus.pages.put(url, render_query_page(page_rows, pageno, n_pages, query_path))
+        queries.append({'url': GVA_DOMAIN + query_path, 'n_pages': n_pages})
+        print("{}: {} incidents, {} query pages".format(csv_fname, len(rows), n_pages), file=sys.stderr)
+
+    with open(corpus.index_fname, 'w', encoding='utf-8') as index_file:
+        json.dump({'queries': queries, 'incidents': incidents}, index_file)
+
+def bench_extract(parser):
+    def bench(args, corpus):
+        rows = corpus.incidents()
+        pages = [(corpus.pages.get(row['incident_url']), Context(row['address'], row['city_or_county'], row['state']))
+                 for row in rows]
+        extractor = EXTRACTORS[parser]()
+        start = time.perf_counter()
+        for text, ctx in pages:
+            extractor.extract_fields(text, ctx)
+        return 1000 * (time.perf_counter() - start) / len(pages), 'ms/page'
+    return bench
+
+def bench_stage1(parser):
+    async def run(corpus, output_fname):
+        async with Stage1Serializer(output_fname, cache=corpus.pages, parser=parser) as serializer:
+            serializer.write_header()
+            for query in corpus.queries():
+                serializer.write_batch(query['url'], query['n_pages'])
+            await serializer.flush_writes()
+
+    def bench(args, corpus):
+        n_pages = sum(query['n_pages'] for query in corpus.queries())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            asyncio.run(run(corpus, os.path.join(tmp_dir, 'stage1.csv')))
+            return 1000 * (time.perf_counter() - start) / n_pages, 'ms/page'
+    return bench
+
+def bench_session(parser):
+    async def run(args, corpus, rows):
+        async def fetch(row):
+            try:
+                await session.get_fields_from_incident_url(row)
+            except Exception:
+                # Already logged by the session.
+                pass
+
+        mock = MockGVA(corpus.pages, latency=args.latency, error_rate=args.error_rate, seed=0)
+        runner, base_url = await start_server(mock)
+        try:
+            rows = [dict(row, incident_url=base_url + row['incident_url'][len(GVA_DOMAIN):]) for row in rows]
+            async with Stage2Session(parser=parser, jobs=args.jobs, limit_per_host=args.conn_limit) as session:
+                start = time.perf_counter()
+                async for _ in ordered_map(fetch, rows, workers=args.conn_limit):
+                    pass
+                return time.perf_counter() - start
+        finally:
+            await runner.cleanup()
+
+    def bench(args, corpus):
+        rows = corpus.incidents()
+        return len(rows) / asyncio.run(run(args, corpus, rows)), 'pages/s'
+    return bench
+
+def bench_stage3(args, corpus):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for csv_fname in corpus.stage2_fnames():
+            shutil.copy(csv_fname, tmp_dir)
+        try:
+            os.chdir(tmp_dir)
+            start = time.perf_counter()
+            stage3.build(full=True)
+            return time.perf_counter() - start, 's'
+        finally:
+            os.chdir(cwd)
+
+BENCHMARKS = {
+    **{'extract_' + parser: bench_extract(parser) for parser in EXTRACTORS},
+    **{'stage1_' + parser: bench_stage1(parser) for parser in PARSERS},
+    **{'session_' + parser: bench_session(parser) for parser in EXTRACTORS},
+    'stage3': bench_stage3,
+}
+
+HIGHER_IS_BETTER = {'pages/s'}
+
+def compare(results, baseline, tolerance):
+    # Returns the names of benchmarks that got worse than the baseline by more than `tolerance`.
+    regressions = []
+    print("{:<20} {:>12} {:<8} {:>12} {:>8}".format('benchmark', 'result', 'unit', 'baseline', 'change'))
+    for name, (value, unit) in results.items():
+        base = baseline.get(name)
+        if base is None or base['unit'] != unit:
+            print("{:<20} {:>12.3f} {:<8}".format(name, value, unit))
+            continue
+        change = (value - base['value']) / base['value']
+        worse = -change if unit in HIGHER_IS_BETTER else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressions.append(name)
+        print("{:<20} {:>12.3f} {:<8} {:>12.3f} {:>+7.1%}{}".format(name, value, unit, base['value'], change, flag))
+    return regressions
+
+def run(args):
+    corpus = Corpus(args.corpus_dir)
+    assert os.path.exists(corpus.index_fname), "{} isn't a corpus. Create it with `benchmark.py build`".format(corpus.root)
+
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        if args.names and not any(name.startswith(prefix) for prefix in args.names):
+            continue
+        print("Running {}".format(name), file=sys.stderr)
+        runs = [bench(args, corpus) for _ in range(args.repeat)]
+        unit = runs[0][1]
+        best = max if unit in HIGHER_IS_BETTER else min
+        results[name] = (best(value for value, _ in runs), unit)
+
+    baseline = {}
+    if args.baseline_fname:
+        with open(args.baseline_fname, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline_fname:
+        with open(args.save_baseline_fname, 'w', encoding='utf-8') as baseline_file:
+            json.dump({name: {'value': value, 'unit': unit} for name, (value, unit) in results.items()},
+                      baseline_file, indent=1)
+    if regressions:
+        print("Regressed: {}".format(', '.join(regressions)), file=sys.stderr)
+        sys.exit(1)
+
+def main():
+    args = parse_args()
+    if args.command == 'build':
+        build(args)
+    else:
+        run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# rebuilds whatever is out of date, like make: stage1.MM.YYYY.csv for each month, then stage2.MM.YYYY.csv from it,
+# then stage3.csv from all of them. Months run side by side in this one process, sharing a connection budget.
+#
+#   build.py 01-2014:03-2018 -l 40 -m 8     # every month from January 2014 to March 2018
+#   build.py -n                             # show what's out of date among the months already in this directory
+
+import asyncio
+import logging as log
+import os
+import re
+import sys
+import traceback as tb
+
+from aiohttp import TCPConnector
+from argparse import ArgumentParser, Namespace
+from calendar import monthrange
+from datetime import date
+from glob import glob
+
+import stage3
+
+from http_cache import cache_from_args
+from metrics import add_metrics_arguments, exporter_from_args
+from rate_limiter import AdaptiveLimiter
+from stage1 import days_between, scrape
+from stage1_serializer import PARSERS, Stage1PageFetcher, failed_fname, refetch_failed
+from stage2 import add_session_arguments, stream_fields_from_incident_url
+from stage2_session import extraction_executor
+
+MONTH_PATTERN = re.compile(r'^(\d{1,2})-(\d{4})$')
+FNAME_PATTERN = re.compile(r'^stage[12]\.(\d{2})\.(\d{4})\.csv$')
+
+def parse_month(parser, arg):
+    match = MONTH_PATTERN.match(arg)
+    if not match:
+        parser.error("{} isn't a month. Use MM-YYYY, or MM-YYYY:MM-YYYY for a range".format(arg))
+    year, month = int(match.group(2)), int(match.group(1))
+    if not 1 <= month <= 12:
+        parser.error("{} isn't a month. Months go from 01 to 12".format(arg))
+    return year, month
+
+def month_range(start, end):
+    (year, month), months = start, []
+    while (year, month) <= end:
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'months',
+        metavar='MONTH',
+        nargs='*',
+        help="months to build, as MM-YYYY or a range MM-YYYY:MM-YYYY " \
+             "(default: every month that has a stage1 or stage2 file in this directory)",
+    )
+    parser.add_argument(
+        '-m', '--months',
+        metavar='NUM',
+        help="build up to NUM months at once (default: 4)",
+        action='store',
+        dest='max_months',
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        '-n', '--dry-run',
+        help="only print what would be rebuilt",
+        action='store_true',
+        dest='dry_run',
+    )
+    parser.add_argument(
+        '-B', '--always-make',
+        help="rebuild everything, even if it's up to date",
+        action='store_true',
+        dest='always_make',
+    )
+    parser.add_argument(
+        '--no-stage3',
+        help="stop after the stage2 files",
+        action='store_false',
+        dest='stage3',
+    )
+    parser.add_argument(
+        '--query-parser',
+        help="set the HTML parser used to scrape query pages (default: html5lib)",
+        action='store',
+        dest='query_parser',
+        choices=sorted(PARSERS),
+        default='html5lib',
+    )
+    parser.add_argument(
+        '-d', '--debug',
+        help="show debug information",
+        action='store_const',
+        dest='log_level',
+        const=log.DEBUG,
+        default=log.WARNING,
+    )
+    add_session_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    args.cache = cache_from_args(parser, args)
+
+    months = set()
+    for arg in args.months:
+        start, _, end = arg.partition(':')
+        months.update(month_range(parse_month(parser, start), parse_month(parser, end or start)))
+    if not args.months:
+        for fname in glob('stage[12].*.csv'):
+            match = FNAME_PATTERN.match(fname)
+            if match:
+                months.add((int(match.group(2)), int(match.group(1))))
+    args.months = sorted(months)
+    return args
+
+def stage1_fname(year, month):
+    return 'stage1.{:02d}.{:04d}.csv'.format(month, year)
+
+def stage2_fname(year, month):
+    return 'stage2.{:02d}.{:04d}.csv'.format(month, year)
+
+def mtime(fname):
+    try:
+        return os.stat(fname).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def stage1_todo(args, year, month):
+    # 'scrape', 'refetch' (some of its query pages failed last time), or None if it's up to date.
+    fname = stage1_fname(year, month)
+    if args.always_make or mtime(fname) is None:
+        return 'scrape'
+    if os.path.exists(failed_fname(fname)):
+        return 'refetch'
+    return None
+
+def stage2_todo(args, year, month, stage1_rebuilt):
+    # stage2 is out of date if it's older than stage1, or if a journal shows it was interrupted.
+    fname = stage2_fname(year, month)
+    output_mtime = mtime(fname)
+    return args.always_make or stage1_rebuilt or output_mtime is None or \
+           output_mtime < mtime(stage1_fname(year, month)) or os.path.exists(fname + '.journal')
+
+def stage3_todo(args, stage2_rebuilt):
+    if args.always_make or stage2_rebuilt:
+        return True
+    output_mtime = mtime(stage3.OUTPUT_FNAME)
+    if output_mtime is None:
+        return bool(glob(stage3.STAGE2_GLOB))
+    return any(mtime(fname) > output_mtime for fname in glob(stage3.STAGE2_GLOB))
+
+class IncompleteMonth(Exception):
+    pass
+
+class Builder(object):
+    def __init__(self, args, limiter, connector, executor):
+        self._args = args
+        self._limiter = limiter
+        self._connector = connector
+        self._executor = executor
+        self._month_slots = asyncio.Semaphore(args.max_months)
+        # Stage1 code reads these from its own command line's arguments.
+        self._stage1_args = Namespace(**{**vars(args),
+                                         'parser': args.query_parser,
+                                         'selenium': False,
+                                         'by_month': True,
+                                         'output_file': None})
+
+    async def _stage1(self, year, month, todo):
+        fname = stage1_fname(year, month)
+        if todo == 'refetch':
+            async with Stage1PageFetcher(cache=self._args.cache,
+                                         parser=self._args.query_parser,
+                                         workers=self._args.conn_limit,
+                                         limiter=self._limiter,
+                                         connector=self._connector,
+                                         proxy=self._args.proxy) as fetcher:
+                n_missing = await refetch_failed(fname, fetcher)
+            if n_missing:
+                raise IncompleteMonth("{} query pages are still missing from {}".format(n_missing, fname))
+            return
+
+        start = date(year, month, 1)
+        end = date(year, month, monthrange(year, month)[1])
+        try:
+            await scrape(self._stage1_args, days_between(start, end), self._limiter, self._connector)
+        except BaseException:
+            # Like make's .DELETE_ON_ERROR: a partial file would look up to date next time.
+            if os.path.exists(fname):
+                os.remove(fname)
+            raise
+        if os.path.exists(failed_fname(fname)):
+            # Building stage2 now would leave those pages' incidents out. The next run refetches them first.
+            raise IncompleteMonth("some query pages couldn't be read; they're listed in {}".format(failed_fname(fname)))
+
+    async def _stage2(self, year, month):
+        # Streamed with a journal, so an interrupted month resumes where it left off.
+        args = Namespace(**{**vars(self._args),
+                            'input_fname': stage1_fname(year, month),
+                            'resume': True})
+        await stream_fields_from_incident_url(args, stage2_fname(year, month),
+                                              limiter=self._limiter,
+                                              executor=self._executor)
+
+    async def build_month(self, year, month):
+        # Returns whether stage2.MM.YYYY.csv was rebuilt. Raises if something failed.
+        label = '{:02d}-{:04d}'.format(month, year)
+        async with self._month_slots:
+            todo = stage1_todo(self._args, year, month)
+            if todo:
+                print("[{}] stage1: {}".format(label, todo), file=sys.stderr)
+                await self._stage1(year, month, todo)
+            if not stage2_todo(self._args, year, month, bool(todo)):
+                return False
+            print("[{}] stage2".format(label), file=sys.stderr)
+            await self._stage2(year, month)
+            print("[{}] done".format(label), file=sys.stderr)
+            return True
+
+def dry_run(args):
+    stage2_rebuilt = False
+    for year, month in args.months:
+        label = '{:02d}-{:04d}'.format(month, year)
+        todo = stage1_todo(args, year, month)
+        if todo:
+            print("[{}] stage1: {}".format(label, todo))
+        if stage2_todo(args, year, month, bool(todo)):
+            print("[{}] stage2".format(label))
+            stage2_rebuilt = True
+    if args.stage3 and stage3_todo(args, stage2_rebuilt):
+        print("stage3")
+
+async def main():
+    args = parse_args()
+    log.basicConfig(level=args.log_level)
+    if args.dry_run:
+        dry_run(args)
+        return
+
+    # One budget of simultaneous requests across every month and stage. --adaptive lets it shrink when the
+    # server struggles; otherwise it stays at --limit.
+    minimum = 1 if args.adaptive else args.conn_limit
+    limiter = AdaptiveLimiter(initial=max(minimum, args.conn_limit // 4), minimum=minimum, maximum=args.conn_limit)
+    connector = TCPConnector(limit_per_host=args.conn_limit)
+    executor = extraction_executor(args.parser, args.jobs) if args.jobs > 0 else None
+
+    try:
+        async with exporter_from_args(args, 'build'):
+            builder = Builder(args, limiter, connector, executor)
+            results = await asyncio.gather(*[builder.build_month(year, month) for year, month in args.months],
+                                           return_exceptions=True)
+
+            failed = []
+            for (year, month), result in zip(args.months, results):
+                if isinstance(result, IncompleteMonth):
+                    print("[{:02d}-{:04d}] failed: {}".format(month, year, result), file=sys.stderr)
+                    failed.append(result)
+                elif isinstance(result, Exception):
+                    print("[{:02d}-{:04d}] failed:".format(month, year), file=sys.stderr)
+                    tb.print_exception(type(result), result, result.__traceback__)
+                    failed.append(result)
+            if failed:
+                print("{} months failed, so stage3.csv was left alone".format(len(failed)), file=sys.stderr)
+                sys.exit(1)
+
+            if args.stage3 and stage3_todo(args, any(results)):
+                print("stage3", file=sys.stderr)
+                # stage3 reads and writes files and doesn't touch the network, so keep the loop free meanwhile.
+                await asyncio.get_event_loop().run_in_executor(None, stage3.build)
+    finally:
+        await connector.close()
+        if executor:
+            executor.shutdown()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
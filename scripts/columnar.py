@@ -0,0 +1,131 @@
+# Parquet storage for stage2/stage3 data, with typed columns instead of CSV strings.
+# The '||'/'::' encoded columns become native list<string> and map<int32, ...> columns.
+
+import numpy as np
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from glob import glob
+
+CSV_SCHEMA = {
+    'congressional_district': np.float64,
+    'state_house_district': np.float64,
+    'state_senate_district': np.float64,
+    'n_guns_involved': np.float64,
+}
+
+LIST_COLUMNS = ['incident_characteristics', 'sources']
+
+MAP_VALUE_TYPES = {
+    'gun_stolen': pa.string(),
+    'gun_type': pa.string(),
+    'participant_age': pa.int32(),
+    'participant_age_group': pa.string(),
+    'participant_gender': pa.string(),
+    'participant_name': pa.string(),
+    'participant_relationship': pa.string(),
+    'participant_status': pa.string(),
+    'participant_type': pa.string(),
+}
+
+SCALAR_TYPES = {
+    'incident_id': pa.int64(),
+    'date': pa.date32(),
+    'n_killed': pa.int32(),
+    'n_injured': pa.int32(),
+    'incident_url_fields_missing': pa.bool_(),
+    'congressional_district': pa.int32(),
+    'state_house_district': pa.int32(),
+    'state_senate_district': pa.int32(),
+    'latitude': pa.float64(),
+    'longitude': pa.float64(),
+    'n_guns_involved': pa.int32(),
+}
+
+PARTITION_COLUMNS = ['year', 'month']
+
+def read_csv(path_or_buf):
+    # Unlike pd.read_csv's defaults, only empty fields are missing; strings like 'NA' are kept as-is.
+    return pd.read_csv(path_or_buf,
+                       dtype=CSV_SCHEMA,
+                       parse_dates=['date'],
+                       keep_default_na=False,
+                       na_values=[''],
+                       encoding='utf-8')
+
+def _to_array(column, type):
+    array = pa.array(column, type=type, from_pandas=True)
+    # Columns backed by Arrow already may come back chunked.
+    return array.combine_chunks() if isinstance(array, pa.ChunkedArray) else array
+
+def _to_list_array(strings):
+    # A few old stage2 files were written with '|' instead of '||'. List items are often URLs, so only the
+    # item separator is widened; their ':'s are left alone.
+    legacy = pc.and_(pc.match_substring(strings, '|'), pc.invert(pc.match_substring(strings, '||')))
+    strings = pc.if_else(legacy, pc.replace_substring(strings, '|', '||'), strings)
+    return pc.split_pattern(strings, '||')
+
+def _to_map_array(strings, value_type):
+    # A few old stage2 files were written with '|' and ':' instead of '||' and '::'.
+    legacy = pc.invert(pc.match_substring(strings, '::'))
+    fixed = pc.replace_substring(pc.replace_substring(strings, ':', '::'), '|', '||')
+    strings = pc.if_else(legacy, fixed, strings)
+    items = pc.split_pattern(strings, '||')
+    pairs = pc.split_pattern(pc.list_flatten(items), '::', max_splits=1)
+    keys = pc.list_element(pairs, 0).cast(pa.int32())
+    values = pc.list_element(pairs, 1).cast(value_type)
+    return pa.MapArray.from_arrays(items.offsets, keys, values, mask=items.is_null())
+
+def to_table(df):
+    arrays = []
+    for name in df.columns:
+        column = df[name]
+        if name in LIST_COLUMNS:
+            array = _to_list_array(_to_array(column, pa.string()))
+        elif name in MAP_VALUE_TYPES:
+            array = _to_map_array(_to_array(column, pa.string()), MAP_VALUE_TYPES[name])
+        elif name == 'date':
+            array = _to_array(column, None).cast(pa.date32())
+        else:
+            array = _to_array(column, SCALAR_TYPES.get(name, pa.string()))
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=list(df.columns))
+
+def write_parquet(df, root, basename):
+    # Writes `df` under `root`, partitioned as year=YYYY/month=M/. Each partition gets its own
+    # basename-N.parquet file, so writing the same basename again replaces only that data.
+    table = to_table(df)
+    table = table.append_column('year', pa.array(df['date'].dt.year, type=pa.int16()))
+    table = table.append_column('month', pa.array(df['date'].dt.month, type=pa.int8()))
+    ds.write_dataset(table,
+                     root,
+                     format='parquet',
+                     partitioning=PARTITION_COLUMNS,
+                     partitioning_flavor='hive',
+                     basename_template=basename + '-{i}.parquet',
+                     existing_data_behavior='overwrite_or_ignore')
+
+def remove_parquet(root, basename, months=None):
+    # Removes what write_parquet() wrote under `root` with this basename, either everywhere or only in the
+    # partitions of the given (year, month) pairs.
+    if months is None:
+        fnames = glob(os.path.join(root, 'year=*', 'month=*', basename + '-*.parquet'))
+    else:
+        fnames = [fname
+                  for year, month in months
+                  for fname in glob(os.path.join(root, 'year={}'.format(year), 'month={}'.format(month),
+                                                 basename + '-*.parquet'))]
+    for fname in fnames:
+        os.remove(fname)
+
+def write_csv_as_parquet(csv_fname, root):
+    basename = os.path.splitext(os.path.basename(csv_fname))[0]
+    write_parquet(read_csv(csv_fname), root, basename)
+
+def load_parquet(root, columns=None, filter=None):
+    # e.g. load_parquet('parquet', columns=['date', 'n_killed'], filter=pc.field('year') == 2017)
+    dataset = ds.dataset(root, format='parquet', partitioning='hive')
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
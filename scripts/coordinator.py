@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# distributed stage 2: hands the incidents in stage1 files out to worker.py processes on any number of
+# machines, and writes each month's stage2 file once all of its incidents have come back
+#
+#   coordinator.py stage1.*.2016.csv                     # on one machine
+#   worker.py http://coordinator-host:8750 -l 20         # on as many machines as you like
+
+import asyncio
+import os
+import pandas as pd
+import sys
+import traceback as tb
+
+from aiohttp import web
+from argparse import ArgumentParser
+
+from metrics import add_metrics_arguments, exporter_from_args, set_gauge
+from stage2 import SCHEMA, add_incident_id
+from stage2_extractor import ALL_FIELD_NAMES
+from stage2_serializer import Stage2Serializer
+from work_queue import WorkQueue
+
+# How long to keep telling workers there's nothing left to do before exiting.
+LINGER_SECONDS = 30
+STATUS_INTERVAL = 30
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'input_fnames',
+        metavar='INPUT',
+        nargs='+',
+        help="stage1 files to crawl. the output for stage1.MM.YYYY.csv is written to stage2.MM.YYYY.csv",
+    )
+    parser.add_argument(
+        '-q', '--queue',
+        metavar='FILE',
+        help="keep the work queue in FILE, so an interrupted run picks up where it left off (default: coordinator.sqlite)",
+        action='store',
+        dest='queue_fname',
+        default='coordinator.sqlite',
+    )
+    parser.add_argument(
+        '--host',
+        metavar='HOST',
+        help="listen for workers on HOST (default: all interfaces)",
+        action='store',
+        dest='host',
+        default='0.0.0.0',
+    )
+    parser.add_argument(
+        '-p', '--port',
+        metavar='PORT',
+        help="listen for workers on PORT (default: 8750)",
+        action='store',
+        dest='port',
+        type=int,
+        default=8750,
+    )
+    parser.add_argument(
+        '--lease',
+        metavar='SECONDS',
+        help="give incidents a worker hasn't finished within SECONDS to another worker (default: 600)",
+        action='store',
+        dest='lease_seconds',
+        type=float,
+        default=600,
+    )
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    for input_fname in args.input_fnames:
+        if not os.path.basename(input_fname).startswith('stage1.'):
+            parser.error("{} isn't named like a stage1 file (stage1.MM.YYYY.csv)".format(input_fname))
+    return args
+
+def output_fname(input_fname):
+    dirname, basename = os.path.split(input_fname)
+    return os.path.join(dirname, 'stage2.' + basename[len('stage1.'):])
+
+def load_rows(input_fname):
+    df = pd.read_csv(input_fname,
+                     dtype=SCHEMA,
+                     parse_dates=['date'],
+                     encoding='utf-8')
+    df = add_incident_id(df)
+    # Rows go over the wire as JSON, so send dates the way stage2 files store them.
+    df['date'] = df['date'].dt.strftime('%Y-%m-%d')
+    columns = [*df.columns, 'incident_url_fields_missing', *ALL_FIELD_NAMES]
+    return columns, df.to_dict('records')
+
+def write_month(output_fname, columns, rows):
+    with Stage2Serializer(output_fname, columns, dtype=SCHEMA) as serializer:
+        for row in rows:
+            serializer.write_row(row)
+
+class Coordinator(object):
+    def __init__(self, queue, lease_seconds):
+        self._queue = queue
+        self._lease_seconds = lease_seconds
+        self._write_lock = asyncio.Lock()
+        self.finished = asyncio.Event()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/lease', self._lease)
+        app.router.add_post('/complete', self._complete)
+        app.router.add_post('/release', self._release)
+        app.router.add_get('/status', self._status)
+        return app
+
+    async def _lease(self, request):
+        body = await request.json()
+        tasks = self._queue.lease(body['worker'], body['n'], self._lease_seconds)
+        # Leasing may have given up on tasks that kept failing, which can finish a month too.
+        self._schedule_write()
+        return web.json_response({'tasks': tasks, 'done': self.finished.is_set()})
+
+    async def _complete(self, request):
+        body = await request.json()
+        self._queue.complete(body['results'])
+        self._schedule_write()
+        return web.json_response({})
+
+    async def _release(self, request):
+        body = await request.json()
+        self._queue.release(body['worker'])
+        print("Worker {} left".format(body['worker']), file=sys.stderr)
+        return web.json_response({})
+
+    async def _status(self, request):
+        return web.json_response(self._queue.counts())
+
+    def _schedule_write(self):
+        def on_done(task):
+            # Nothing awaits this task, so report a failure here. The month is tried again on the next status tick.
+            if not task.cancelled() and task.exception():
+                exc = task.exception()
+                print("Couldn't write a finished month:", file=sys.stderr)
+                tb.print_exception(type(exc), exc, exc.__traceback__)
+
+        asyncio.ensure_future(self.write_finished_months()).add_done_callback(on_done)
+
+    async def write_finished_months(self):
+        # Only one call writes at a time, so a month is never written twice.
+        async with self._write_lock:
+            for month, output_fname, columns in self._queue.finished_months():
+                rows = list(self._queue.results(month))
+                # Writing a month takes a while, so do it off the event loop to keep answering workers meanwhile.
+                await asyncio.get_event_loop().run_in_executor(None, write_month, output_fname, columns, rows)
+                self._queue.mark_written(month)
+                print("Wrote {} ({} incidents)".format(output_fname, len(rows)), file=sys.stderr)
+
+            if self._queue.all_written():
+                self.finished.set()
+
+    def report_status(self):
+        counts = self._queue.counts()
+        for state, n in counts.items():
+            set_gauge('work_queue_tasks', n, state=state)
+        print("{done} incidents done, {leased} leased to workers, {pending} pending".format(**counts), file=sys.stderr)
+
+async def main():
+    args = parse_args()
+
+    with WorkQueue(args.queue_fname) as queue:
+        for input_fname in args.input_fnames:
+            month = os.path.basename(input_fname)
+            if not queue.has_month(month):
+                columns, rows = load_rows(input_fname)
+                queue.add_month(month, output_fname(input_fname), columns, rows)
+                print("Queued {} incidents from {}".format(len(rows), input_fname), file=sys.stderr)
+
+        coordinator = Coordinator(queue, args.lease_seconds)
+        runner = web.AppRunner(coordinator.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, args.host, args.port).start()
+        print("Listening for workers on port {}".format(args.port), file=sys.stderr)
+
+        try:
+            async with exporter_from_args(args, 'coordinator'):
+                while not coordinator.finished.is_set():
+                    # Also catches months left finished by an interrupted run, which still need to be written.
+                    await coordinator.write_finished_months()
+                    coordinator.report_status()
+                    try:
+                        await asyncio.wait_for(coordinator.finished.wait(), STATUS_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                coordinator.report_status()
+                await asyncio.sleep(LINGER_SECONDS)
+        finally:
+            await runner.cleanup()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
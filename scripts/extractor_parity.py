@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# checks that every HTML parser backend scrapes identical data from saved pages: the incident pages committed
+# in fixtures/incident_pages, or every page in a --cache directory. exits with 1 if any of them disagree.
+#
+#   extractor_parity.py                             # the fixtures
+#   extractor_parity.py cache stage2.*.csv          # a cache, with incident addresses from the stage2 files
+
+import os
+import pandas as pd
+import sys
+import time
+
+from argparse import ArgumentParser
+from collections import defaultdict
+
+from http_cache import ResponseCache
+from stage1_serializer import PARSERS
+from stage2_extractor import EXTRACTORS
+from stage2_session import Context
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'incident_pages')
+# Lists each fixture page with the incident it was saved from. The address columns double as its context.
+FIXTURES_INDEX = os.path.join(FIXTURES_DIR, 'pages.csv')
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'cache_dir',
+        metavar='CACHE',
+        nargs='?',
+        help="cache directory populated by stage1.py/stage2.py --cache (default: check the fixture pages instead)",
+    )
+    parser.add_argument(
+        'context_fnames',
+        metavar='CSV',
+        nargs='*',
+        help="stage1 or stage2 files to read incident addresses from. " \
+             "incidents not listed in any of these are extracted with an empty address",
+    )
+    return parser.parse_args()
+
+def load_contexts(fnames):
+    contexts = {}
+    for fname in fnames:
+        df = pd.read_csv(fname, usecols=['incident_url', 'address', 'city_or_county', 'state'], encoding='utf-8')
+        df = df.fillna('')
+        for row in df.itertuples(index=False):
+            contexts[row.incident_url] = Context(address=row.address,
+                                                 city_or_county=row.city_or_county,
+                                                 state=row.state)
+    return contexts
+
+def iter_cache_pages(cache_dir):
+    for url, text in ResponseCache(cache_dir).items():
+        yield url, url, text
+
+def iter_fixture_pages():
+    df = pd.read_csv(FIXTURES_INDEX, usecols=['page', 'incident_url'], encoding='utf-8')
+    for row in df.itertuples(index=False):
+        with open(os.path.join(FIXTURES_DIR, row.page), encoding='utf-8') as page_file:
+            yield row.page, row.incident_url, page_file.read()
+
+def run_all(backends, *args):
+    results, times = {}, {}
+    for name, func in backends.items():
+        start = time.perf_counter()
+        try:
+            results[name] = func(*args)
+        except Exception as exc:
+            results[name] = exc
+        times[name] = time.perf_counter() - start
+    return results, times
+
+def same(results):
+    values = list(results.values())
+    # Compare exceptions by type, since exception instances never compare equal.
+    values = [type(x) if isinstance(x, Exception) else x for x in values]
+    return all(value == values[0] for value in values)
+
+def main():
+    args = parse_args()
+    if args.cache_dir:
+        pages = iter_cache_pages(args.cache_dir)
+        contexts = load_contexts(args.context_fnames)
+    else:
+        pages = iter_fixture_pages()
+        contexts = load_contexts([FIXTURES_INDEX, *args.context_fnames])
+    empty_ctx = Context(address='', city_or_county='', state='')
+
+    extractors = {name: cls().extract_fields for name, cls in EXTRACTORS.items()}
+    n_pages, n_mismatches = 0, 0
+    total_times = defaultdict(float)
+    for name, url, text in pages:
+        if '/incident/' in url:
+            results, times = run_all(extractors, text, contexts.get(url, empty_ctx))
+        else:
+            results, times = run_all(PARSERS, text)
+
+        n_pages += 1
+        for name, seconds in times.items():
+            total_times[name] += seconds
+        if not same(results):
+            n_mismatches += 1
+            print("MISMATCH: {}".format(name))
+            for name, result in results.items():
+                print("  {}: {!r}".format(name, result))
+
+    print("Compared {} pages, {} mismatches".format(n_pages, n_mismatches))
+    for name, seconds in sorted(total_times.items()):
+        print("  {}: {:.3f}s total, {:.2f}ms/page".format(name, seconds, 1000 * seconds / max(n_pages, 1)))
+    return 1 if n_mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# Renders stage1 query result pages and stage2 incident pages from our own CSVs, in the markup that
+# stage1_serializer and stage2_extractor scrape. Scraping a rendered page gives back the row it was
+# rendered from, so these pages can stand in for gunviolencearchive.org in benchmarks and load tests.
+
+import csv
+
+from datetime import datetime
+from html import escape
+
+RESULTS_PER_PAGE = 25
+
+PARTICIPANT_KEYS = ['type', 'name', 'age', 'age_group', 'gender', 'status', 'relationship']
+GUN_KEYS = ['type', 'stolen']
+DISTRICT_KEYS = ['congressional_district', 'state_senate_district', 'state_house_district']
+
+NO_INCIDENTS_PAGE = '''<html><body><div id="block-system-main">
+<table class="responsive"><tbody><tr><td colspan="7">There are currently no incidents available.</td></tr></tbody></table>
+</div></body></html>'''
+
+def iter_stage2_rows(csv_fnames):
+    for csv_fname in csv_fnames:
+        with open(csv_fname, encoding='utf-8', newline='') as csv_file:
+            yield from csv.DictReader(csv_file)
+
+def _title(key):
+    return key.replace('_', ' ').title() # e.g. 'age_group' -> 'Age Group'
+
+def _split_list(value):
+    if not value:
+        return []
+    # A few old stage2 files were written with '|' and ':' instead of '||' and '::'.
+    sep = '|' if '|' in value and '||' not in value else '||'
+    return value.split(sep)
+
+def _split_dict(value):
+    if not value:
+        return {}
+    insep = '::' if '::' in value else ':'
+    outsep = '||' if insep == '::' else '|'
+    return {int(k): v for k, v in (item.split(insep, 1) for item in value.split(outsep))}
+
+def _groups(row, prefix, keys):
+    # Turns parallel 'id::value||...' columns back into one {title: value} dict per participant/gun.
+    columns = {key: _split_dict(row.get(prefix + key, '')) for key in keys}
+    ids = set().union(*columns.values())
+    return [[(_title(key), columns[key][id]) for key in keys if id in columns[key]]
+            for id in range(max(ids) + 1)] if ids else []
+
+def _render_groups(groups):
+    return ''.join('<ul>{}</ul>'.format(''.join('<li>{}: {}</li>'.format(escape(k), escape(v)) for k, v in group))
+                   for group in groups)
+
+def _section(title, body):
+    return '<div><h2>{}</h2>{}</div>\n'.format(title, body)
+
+def render_incident_page(row):
+    sections = []
+
+    spans = [row['address'], '{}, {}'.format(row['city_or_county'], row['state'])]
+    if row.get('latitude') and row.get('longitude'):
+        spans.append('Geolocation: {}, {}'.format(row['latitude'], row['longitude']))
+    if row.get('location_description'):
+        spans.append(row['location_description'])
+    sections.append(_section('Location', ''.join('<span>{}</span>'.format(escape(span)) for span in spans)))
+
+    participants = _groups(row, 'participant_', PARTICIPANT_KEYS)
+    if participants:
+        sections.append(_section('Participants', _render_groups(participants)))
+
+    characteristics = _split_list(row.get('incident_characteristics'))
+    if characteristics:
+        items = ''.join('<li>{}</li>'.format(escape(item)) for item in characteristics)
+        sections.append(_section('Incident Characteristics', '<ul>{}</ul>'.format(items)))
+
+    if row.get('notes'):
+        sections.append(_section('Notes', '<p>{}</p>'.format(escape(row['notes']))))
+
+    if row.get('n_guns_involved'):
+        n_guns = int(float(row['n_guns_involved']))
+        body = '<p>{} {} involved.</p>'.format(n_guns, 'gun' if n_guns == 1 else 'guns')
+        sections.append(_section('Guns Involved', body + _render_groups(_groups(row, 'gun_', GUN_KEYS))))
+
+    sources = _split_list(row.get('sources'))
+    if sources:
+        links = ''.join('<a href="{0}">{0}</a><br>'.format(escape(source)) for source in sources)
+        sections.append(_section('Sources', links))
+
+    districts = [(key, row[key]) for key in DISTRICT_KEYS if row.get(key)]
+    if districts:
+        lines = ''.join('{}: {}<br>'.format(_title(key), int(float(value))) for key, value in districts)
+        sections.append(_section('District', lines))
+
+    return '<html><body><div id="block-system-main">\n{}</div></body></html>'.format(''.join(sections))
+
+def _query_date(date):
+    # stage2 writes YYYY-MM-DD. Query results show e.g. 'January 1, 2014'.
+    date = datetime.strptime(date, '%Y-%m-%d')
+    return '{:%B} {}, {}'.format(date, date.day, date.year)
+
+def render_query_page(rows, page, n_pages, query_path):
+    # `rows` are one page of results, newest first, as the site lists them.
+    trs = []
+    for row in rows:
+        links = '<a href="/incident/{}">View Incident</a>'.format(escape(row['incident_id']))
+        if row.get('source_url'):
+            links += ' <a href="{}">View Source</a>'.format(escape(row['source_url']))
+        tds = [_query_date(row['date']), row['state'], row['city_or_county'], row['address'],
+               row['n_killed'], row['n_injured']]
+        trs.append('<tr>{}<td>{}</td></tr>'.format(''.join('<td>{}</td>'.format(escape(td)) for td in tds), links))
+
+    table = '<table class="responsive"><thead><tr><th>Incident Date</th></tr></thead><tbody>{}</tbody></table>'.format(
+        ''.join(trs))
+    pager = ''
+    if n_pages > 1:
+        pager = '<ul class="pager"><li><a title="Go to last page" href="{}?page={}">last</a></li></ul>'.format(
+            escape(query_path), n_pages - 1)
+    return '<html><body><div id="block-system-main">\n{}{}</div></body></html>'.format(table, pager)
@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+
+class CacheMissError(Exception):
+    def __init__(self, url):
+        super().__init__("{} is not in the cache".format(url))
+        self.url = url
+
+class ResponseCache(object):
+    # Stores response bodies on disk, gzipped, under the SHA-256 of their URL. Entries older than `ttl` seconds
+    # are ignored, and once the cache grows past `max_size` bytes the least recently used entries are evicted.
+    def __init__(self, root, ttl=None, max_size=None, offline=False):
+        self.root = root
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self._size = None
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key[:2], key + '.gz')
+
+    def _entries(self):
+        if not os.path.isdir(self.root):
+            return
+        for subdir in os.scandir(self.root):
+            if subdir.is_dir():
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith('.gz'):
+                        yield entry
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8', newline='') as file:
+                header = json.loads(file.readline())
+                if self.ttl is not None and time.time() - header['time'] > self.ttl:
+                    return None
+                text = file.read()
+        except FileNotFoundError:
+            return None
+
+        # Bump the mtime so eviction treats this entry as recently used.
+        os.utime(path)
+        return text
+
+    def items(self):
+        for entry in self._entries():
+            with gzip.open(entry.path, 'rt', encoding='utf-8', newline='') as file:
+                header = json.loads(file.readline())
+                yield header['url'], file.read()
+
+    def put(self, url, text):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', newline='') as file:
+            file.write(json.dumps({'url': url, 'time': time.time()}) + '\n')
+            file.write(text)
+        # An entry being refreshed replaces the old file, whose size mustn't be counted twice.
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_path, path)
+
+        if self.max_size is not None:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self._size += os.path.getsize(path) - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the limit so we don't have to rescan the cache on every put.
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self._size = sum(entry.stat().st_size for entry in entries)
+        target = self.max_size * 0.9
+        for entry in entries:
+            if self._size <= target:
+                break
+            self._size -= entry.stat().st_size
+            os.remove(entry.path)
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        '--cache',
+        metavar='DIR',
+        help="cache fetched pages in DIR and reuse them on later runs",
+        action='store',
+        dest='cache_dir',
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        metavar='DAYS',
+        help="ignore cached pages older than DAYS days",
+        action='store',
+        dest='cache_ttl',
+        type=float,
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB',
+        help="evict least recently used pages once the cache grows past MB megabytes",
+        action='store',
+        dest='cache_size',
+        type=float,
+    )
+    parser.add_argument(
+        '--offline',
+        help="serve pages only from the cache; pages that aren't cached are treated as failed fetches. requires --cache",
+        action='store_true',
+        dest='offline',
+    )
+
+def cache_from_args(parser, args):
+    if args.cache_dir is None:
+        if args.offline:
+            parser.error("--offline requires --cache")
+        return None
+
+    return ResponseCache(args.cache_dir,
+                         ttl=None if args.cache_ttl is None else args.cache_ttl * 24 * 60 * 60,
+                         max_size=None if args.cache_size is None else int(args.cache_size * 1024 * 1024),
+                         offline=args.offline)
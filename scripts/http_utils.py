@@ -0,0 +1,102 @@
+import asyncio
+import errno
+import math
+import numpy as np
+import platform
+import sys
+import time
+
+from aiohttp.client_exceptions import ClientOSError, ServerDisconnectedError
+from aiohttp.hdrs import RETRY_AFTER
+from asyncio import CancelledError
+from email.utils import parsedate_to_datetime
+
+import metrics
+
+from log_utils import log_first_call
+
+def _compute_wait(average_wait, rng_base):
+    log_first_call()
+    log_average_wait = math.log(average_wait, rng_base)
+    fuzz = np.random.standard_normal(size=1)[0]
+    return int(np.ceil(rng_base ** (log_average_wait + fuzz)))
+
+def _parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date.
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, int(parsedate_to_datetime(value).timestamp() - time.time()))
+    except (TypeError, ValueError):
+        return None
+
+def _should_retry(status):
+    # Retry server errors, and 429 Too Many Requests since it just means we're going too fast.
+    return status >= 500 or status == 429
+
+def _status_from_exception(exc):
+    if isinstance(exc, CancelledError):
+        return '<canceled>'
+    if isinstance(exc, ClientOSError) and platform.system() == 'Windows' and exc.errno == 10054:
+        # WinError: An existing connection was forcibly closed by the remote host
+        return '<conn closed>'
+    if isinstance(exc, ServerDisconnectedError) or (isinstance(exc, ClientOSError) and exc.errno == errno.ECONNRESET):
+        # The server hung up before sending a response
+        return '<conn closed>'
+    if isinstance(exc, asyncio.TimeoutError):
+        return '<timed out>'
+
+    return ''
+
+def _log_retry(method, url, status, retry_wait):
+    print("{} request to {} failed with status {}. Trying again in {}s...".format(method, url, status, retry_wait), file=sys.stderr)
+
+async def request(sess, method, url, limiter=None, average_wait=10, rng_base=2, max_attempts=None, **kwargs):
+    # Makes a request, retrying server errors, rate limiting and dropped connections until it gets a response
+    # that's either successful or a client error. The response body has already been read when this returns.
+    # If max_attempts is given, the last attempt's server error response or exception is handed to the caller.
+    attempt = 0
+    while True:
+        attempt += 1
+        last_attempt = attempt == max_attempts
+        start = await limiter.acquire() if limiter else None
+        attempt_start = time.perf_counter()
+        ok, retry_after = None, None
+        try:
+            try:
+                resp = await sess.request(method, url, **kwargs)
+                if not _should_retry(resp.status):
+                    # Read the body while we hold our slot so the limiter sees the whole cost of the request.
+                    metrics.inc('http_response_bytes_total', len(await resp.read()))
+            except Exception as exc:
+                status = _status_from_exception(exc)
+                if not status:
+                    raise
+                ok = False
+                if last_attempt:
+                    raise
+            else:
+                status = resp.status
+                metrics.inc('http_responses_total', status=status)
+                if not _should_retry(status): # Suceeded or client error
+                    ok = True
+                    return resp
+                # It's a server error. Dispose the response and retry.
+                ok = False
+                retry_after = _parse_retry_after(resp.headers.get(RETRY_AFTER))
+                if last_attempt:
+                    return resp
+                await resp.release()
+        finally:
+            metrics.observe('http_request_seconds', time.perf_counter() - attempt_start, method=method)
+            if limiter:
+                limiter.release(start, ok, retry_after)
+
+        wait = retry_after if retry_after is not None else _compute_wait(average_wait, rng_base)
+        _log_retry(method, url, status, wait)
+        metrics.inc('http_retries_total', status=status)
+        await asyncio.sleep(wait)
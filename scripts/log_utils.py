@@ -1,11 +1,11 @@
 import logging as log
-
-from inspect import stack
+import sys
 
 _funcs_logged = set()
 
 def log_first_call(level=log.DEBUG):
-    funcname = stack()[1].function
+    # sys._getframe is cheap; inspect.stack() reads source files for every frame and costs more than parsing a page.
+    funcname = sys._getframe(1).f_code.co_name
     if funcname not in _funcs_logged:
         _funcs_logged.add(funcname)
         log.log(level, "%s() called", funcname)
@@ -0,0 +1,207 @@
+# Process-wide counters, gauges and histograms, periodically exported as JSON lines and/or a
+# Prometheus text file (e.g. for node_exporter's textfile collector).
+#
+# Recording is always on and costs a dict lookup, so call sites don't need to check whether
+# anything is being exported.
+
+import asyncio
+import bisect
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+
+PREFIX = 'gva_'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket the q-th observation falls in.
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    _gauges[_key(name, labels)] = value
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = _Histogram(buckets)
+    histogram.observe(value)
+
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else '{:g}'.format(bound)
+
+def prometheus_text(const_labels=()):
+    lines = []
+    typed = set()
+    const_labels = tuple(const_labels)
+
+    def header(name, type):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, type))
+
+    for (name, labels), value in sorted(_counters.items()):
+        header(name, 'counter')
+        lines.append('{}{}{} {}'.format(PREFIX, name, _format_labels(const_labels + labels), value))
+    for (name, labels), value in sorted(_gauges.items()):
+        header(name, 'gauge')
+        lines.append('{}{}{} {}'.format(PREFIX, name, _format_labels(const_labels + labels), value))
+    for (name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0]):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip((*histogram.buckets, float('inf')), histogram.counts):
+            cumulative += count
+            bucket_labels = const_labels + labels + (('le', _format_bound(bound)),)
+            lines.append('{}{}_bucket{} {}'.format(PREFIX, name, _format_labels(bucket_labels), cumulative))
+        lines.append('{}{}_sum{} {:g}'.format(PREFIX, name, _format_labels(const_labels + labels), histogram.sum))
+        lines.append('{}{}_count{} {}'.format(PREFIX, name, _format_labels(const_labels + labels), histogram.count))
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    def flat(key):
+        name, labels = key
+        return name + _format_labels(labels)
+
+    return {
+        'counters': {flat(key): value for key, value in sorted(_counters.items())},
+        'gauges': {flat(key): value for key, value in sorted(_gauges.items())},
+        'histograms': {flat(key): {'count': histogram.count,
+                                   'sum': round(histogram.sum, 6),
+                                   'p50': histogram.quantile(0.5),
+                                   'p95': histogram.quantile(0.95)}
+                       for key, histogram in sorted(_histograms.items(), key=lambda item: item[0])},
+    }
+
+class MetricsExporter(object):
+    def __init__(self, stage, json_fname=None, prom_fname=None, interval=10):
+        self._stage = stage
+        self._json_fname = json_fname
+        self._prom_fname = prom_fname
+        self._interval = interval
+        self._task = None
+
+    async def __aenter__(self):
+        if self._json_fname or self._prom_fname:
+            self._last_time, self._last_counters = time.time(), {}
+            self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self.export()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            self.export()
+
+    def export(self):
+        try:
+            if self._json_fname:
+                self._export_json()
+            if self._prom_fname:
+                self._export_prometheus()
+        except OSError as exc:
+            print("Couldn't export metrics: {}".format(exc), file=sys.stderr)
+
+    def _export_json(self):
+        now = time.time()
+        record = {'time': round(now, 3), 'stage': self._stage, **snapshot()}
+        # Per-second rates since the previous line, e.g. rows_written_total -> rows per second.
+        elapsed = now - self._last_time
+        record['rates'] = {name: round((value - self._last_counters.get(name, 0)) / elapsed, 3)
+                           for name, value in record['counters'].items()} if elapsed > 0 else {}
+        self._last_time, self._last_counters = now, record['counters']
+        with open(self._json_fname, 'a', encoding='utf-8') as json_file:
+            json_file.write(json.dumps(record) + '\n')
+
+    def _export_prometheus(self):
+        # Written to a temp file and renamed, so a scraper never sees a partial file.
+        tmp_fname = self._prom_fname + '.tmp'
+        with open(tmp_fname, 'w', encoding='utf-8') as prom_file:
+            prom_file.write(prometheus_text([('stage', self._stage)]))
+        os.replace(tmp_fname, self._prom_fname)
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        '--metrics-json',
+        metavar='FILE',
+        help="append a JSON snapshot of request, parsing and throughput metrics to FILE every --metrics-interval seconds",
+        action='store',
+        dest='metrics_json',
+    )
+    parser.add_argument(
+        '--metrics-prom',
+        metavar='FILE',
+        help="keep FILE updated with the same metrics in Prometheus text format",
+        action='store',
+        dest='metrics_prom',
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        metavar='SECONDS',
+        help="how often to export metrics (default: 10)",
+        action='store',
+        dest='metrics_interval',
+        type=float,
+        default=10,
+    )
+
+def exporter_from_args(args, stage):
+    return MetricsExporter(stage,
+                           json_fname=args.metrics_json,
+                           prom_fname=args.metrics_prom,
+                           interval=args.metrics_interval)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# A local stand-in for gunviolencearchive.org with fault injection, for benchmarks and load tests.
+#
+# It can serve pages saved in a cache directory, or render the /query form, query results and
+# /incident/<id> pages from stage2 files. It also works as an HTTP proxy, so the crawler can be pointed
+# at it with --proxy without changing any URLs:
+#
+#   mock_server.py intermediate/stage2.01.2018.csv --scale 10 --error-rate 0.05 --drop-rate 0.01 &
+#   stage1.py 01-2018 --proxy http://127.0.0.1:8080
+#   stage2.py 01-2018 --proxy http://127.0.0.1:8080
+
+import asyncio
+import bisect
+import random
+import sys
+import uuid
+
+from aiohttp import web
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime
+
+from gva_pages import NO_INCIDENTS_PAGE, RESULTS_PER_PAGE, iter_stage2_rows, render_incident_page, render_query_page
+from http_cache import ResponseCache
+from stage1_serializer import GVA_DOMAIN
+
+# Incident ids of the copies made by --scale are offset by multiples of this.
+SCALE_ID_STRIDE = 10 ** 8
+
+SESSION_COOKIE = 'SESSmock'
+
+QUERY_FORM_PAGE = '''<html><body><div id="block-system-main">
+<form action="/query" method="post" id="gva-query">
+<div class="filter-dropdown-trigger">Add a rule</div>
+<ul><li><a href="/query/filter/add/date/nojs">Date</a></li><li><a href="/query/filter/add/participant/nojs">Participants</a></li></ul>
+{rules}
+<input type="hidden" name="form_build_id" value="form-mock">
+<input type="hidden" name="form_id" value="gva_query_form">
+<input type="submit" id="edit-actions-execute" name="op" value="Search">
+</form></div></body></html>'''
+
+DATE_RULE = '''<div class="rule">
+<input id="edit-query-filters-0-outer-filter-field-date-from" name="query[filters][0][outer][filter][field][date-from]" value="">
+<input id="edit-query-filters-0-outer-filter-field-date-to" name="query[filters][0][outer][filter][field][date-to]" value="">
+</div>'''
+
+LATENCY_DISTRIBUTIONS = {
+    'fixed': lambda rng, mean: mean,
+    'uniform': lambda rng, mean: rng.uniform(0, 2 * mean),
+    'exponential': lambda rng, mean: rng.expovariate(1 / mean),
+    # Heavy-tailed: the median is about mean/2, and a few requests take many times the mean.
+    'lognormal': lambda rng, mean: mean * rng.lognormvariate(-0.72, 1.2),
+}
+
+class RenderedSite(object):
+    # Renders pages from stage2 rows. With scale > 1, every incident appears `scale` times on the same
+    # day, with ids offset by SCALE_ID_STRIDE, to load-test at more than the real volume.
+    def __init__(self, csv_fnames, scale=1):
+        self._rows = {}
+        by_date = defaultdict(list)
+        for row in iter_stage2_rows(csv_fnames):
+            incident_id = int(row['incident_id'])
+            self._rows[incident_id] = row
+            by_date[row['date']].extend(incident_id + copy * SCALE_ID_STRIDE for copy in range(scale))
+        self._dates = sorted(by_date)
+        self._ids_by_date = [by_date[date] for date in self._dates]
+
+    def __len__(self):
+        return sum(map(len, self._ids_by_date))
+
+    def incident_row(self, incident_id):
+        row = self._rows.get(incident_id % SCALE_ID_STRIDE)
+        if row is None:
+            return None
+        return dict(row, incident_id=str(incident_id))
+
+    def incident_page(self, incident_id):
+        row = self.incident_row(incident_id)
+        return None if row is None else render_incident_page(row)
+
+    def incidents_between(self, start, end):
+        # Dates are YYYY-MM-DD, so they compare correctly as strings. Newest first, like the site.
+        lo, hi = bisect.bisect_left(self._dates, start), bisect.bisect_right(self._dates, end)
+        ids = [incident_id for ids in self._ids_by_date[lo:hi] for incident_id in ids]
+        ids.reverse()
+        return ids
+
+class MockGVA(object):
+    # `site` is either a RenderedSite, or anything with a get(url) method (e.g. a ResponseCache) that returns
+    # the saved page for a gunviolencearchive.org URL. Only a RenderedSite can answer queries.
+    def __init__(self, site,
+                 latency=0,
+                 latency_distribution='exponential',
+                 error_rate=0,
+                 not_found_rate=0,
+                 drop_rate=0,
+                 rate_limit=None,
+                 seed=None):
+        self._site = site
+        self._latency = latency
+        self._latency_distribution = LATENCY_DISTRIBUTIONS[latency_distribution]
+        self._error_rate = error_rate
+        self._not_found_rate = not_found_rate
+        self._drop_rate = drop_rate
+        self._rate_limit = rate_limit
+        self._seed = seed
+        self._random = random.Random(seed)
+
+        self._bucket_size = max(1, rate_limit or 0)
+        self._tokens = self._bucket_size
+        self._last_refill = None
+        self._sessions = {}
+        self._queries = {}
+
+    def make_app(self):
+        app = web.Application(middlewares=[self._inject_faults])
+        if isinstance(self._site, RenderedSite):
+            app.router.add_get('/query', self._query_form)
+            app.router.add_post('/query', self._submit_query)
+            app.router.add_get('/query/filter/add/date/nojs', self._add_date_rule)
+            app.router.add_get('/query/{query_id}', self._query_results)
+            app.router.add_get('/incident/{incident_id:[0-9]+}', self._incident)
+        else:
+            app.router.add_get('/{path:.*}', self._saved_page)
+        return app
+
+    def _take_token(self):
+        # Token bucket refilled at `rate_limit` requests per second, holding up to one second's worth.
+        # Below one request per second it still has to hold a whole request, or none would ever get through.
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        if self._last_refill is not None:
+            self._tokens = min(self._bucket_size, self._tokens + (now - self._last_refill) * self._rate_limit)
+        self._last_refill = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    @web.middleware
+    async def _inject_faults(self, request, handler):
+        if self._rate_limit and not self._take_token():
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        if self._latency:
+            await asyncio.sleep(self._latency_distribution(self._random, self._latency))
+        if self._random.random() < self._drop_rate:
+            # Hang up without answering, like a reset connection.
+            request.transport.abort()
+            raise asyncio.CancelledError()
+        if self._random.random() < self._error_rate:
+            return web.Response(status=self._random.choice([500, 502, 503]))
+        return await handler(request)
+
+    def _html(self, text):
+        return web.Response(text=text, content_type='text/html')
+
+    async def _saved_page(self, request):
+        text = self._site.get(GVA_DOMAIN + request.path_qs)
+        if text is None:
+            raise web.HTTPNotFound()
+        return self._html(text)
+
+    async def _incident(self, request):
+        incident_id = int(request.match_info['incident_id'])
+        # The same incidents are always missing, so retrying doesn't change the outcome.
+        if self._not_found_rate and random.Random(incident_id ^ (self._seed or 0)).random() < self._not_found_rate:
+            raise web.HTTPNotFound()
+        text = self._site.incident_page(incident_id)
+        if text is None:
+            raise web.HTTPNotFound()
+        return self._html(text)
+
+    def _session(self, request):
+        session_id = request.cookies.get(SESSION_COOKIE)
+        if session_id not in self._sessions:
+            session_id = uuid.uuid4().hex
+            self._sessions[session_id] = {'date_rule': False}
+        return session_id, self._sessions[session_id]
+
+    async def _query_form(self, request):
+        session_id, session = self._session(request)
+        resp = self._html(QUERY_FORM_PAGE.format(rules=DATE_RULE if session['date_rule'] else ''))
+        resp.set_cookie(SESSION_COOKIE, session_id)
+        return resp
+
+    async def _add_date_rule(self, request):
+        # Without JavaScript, Drupal adds the rule to the session and sends us back to the form.
+        session_id, session = self._session(request)
+        session['date_rule'] = True
+        resp = web.HTTPFound('/query')
+        resp.set_cookie(SESSION_COOKIE, session_id)
+        raise resp
+
+    async def _submit_query(self, request):
+        data = await request.post()
+        try:
+            start, end = [datetime.strptime(data['query[filters][0][outer][filter][field][date-{}]'.format(which)],
+                                            '%m/%d/%Y').strftime('%Y-%m-%d')
+                          for which in ('from', 'to')]
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest(text="Expected a date rule with both dates filled in")
+
+        query_id = uuid.uuid4().hex
+        self._queries[query_id] = self._site.incidents_between(start, end)
+        raise web.HTTPFound('/query/' + query_id)
+
+    async def _query_results(self, request):
+        query_id = request.match_info['query_id']
+        ids = self._queries.get(query_id)
+        if ids is None:
+            raise web.HTTPNotFound()
+        if not ids:
+            return self._html(NO_INCIDENTS_PAGE)
+
+        n_pages = (len(ids) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
+        pageno = int(request.query.get('page', 0))
+        rows = [self._site.incident_row(incident_id)
+                for incident_id in ids[pageno * RESULTS_PER_PAGE:(pageno + 1) * RESULTS_PER_PAGE]]
+        return self._html(render_query_page(rows, pageno, n_pages, request.path))
+
+async def start_server(mock, host='127.0.0.1', port=0):
+    # Returns (runner, base_url). Call `await runner.cleanup()` to stop the server.
+    runner = web.AppRunner(mock.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, 'http://{}:{}'.format(host, port)
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'csv_fnames',
+        metavar='FILE',
+        nargs='*',
+        help="stage2 files to render the query form, query results and incident pages from",
+    )
+    parser.add_argument(
+        '-c', '--cache',
+        metavar='DIR',
+        help="serve the pages saved in this cache directory instead (see --cache, or benchmark.py build)",
+        action='store',
+        dest='cache_dir',
+    )
+    parser.add_argument(
+        '-p', '--port',
+        metavar='PORT',
+        help="listen on PORT (default: 8080)",
+        action='store',
+        dest='port',
+        type=int,
+        default=8080,
+    )
+    parser.add_argument(
+        '--scale',
+        metavar='NUM',
+        help="serve NUM copies of every incident (default: 1)",
+        action='store',
+        dest='scale',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--latency',
+        metavar='SECONDS',
+        help="average response delay (default: 0)",
+        action='store',
+        dest='latency',
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        '--latency-distribution',
+        help="distribution of response delays (default: exponential)",
+        action='store',
+        dest='latency_distribution',
+        choices=sorted(LATENCY_DISTRIBUTIONS),
+        default='exponential',
+    )
+    parser.add_argument(
+        '--error-rate',
+        metavar='RATE',
+        help="fraction of requests that fail with a 500, 502 or 503 (default: 0)",
+        action='store',
+        dest='error_rate',
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        '--not-found-rate',
+        metavar='RATE',
+        help="fraction of incidents whose pages are always 404 (default: 0)",
+        action='store',
+        dest='not_found_rate',
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        '--drop-rate',
+        metavar='RATE',
+        help="fraction of requests whose connection is dropped without a response (default: 0)",
+        action='store',
+        dest='drop_rate',
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        '--rate-limit',
+        metavar='NUM',
+        help="answer requests beyond NUM per second with 429 Too Many Requests",
+        action='store',
+        dest='rate_limit',
+        type=float,
+    )
+    parser.add_argument(
+        '--seed',
+        metavar='NUM',
+        help="seed the random number generator, for repeatable runs",
+        action='store',
+        dest='seed',
+        type=int,
+    )
+
+    args = parser.parse_args()
+    if bool(args.csv_fnames) == bool(args.cache_dir):
+        parser.error("give either stage2 files or --cache, but not both")
+    return args
+
+def main():
+    args = parse_args()
+    if args.cache_dir:
+        site = ResponseCache(args.cache_dir)
+    else:
+        site = RenderedSite(args.csv_fnames, scale=args.scale)
+        print("Serving {} incidents".format(len(site)), file=sys.stderr)
+
+    mock = MockGVA(site,
+                   latency=args.latency,
+                   latency_distribution=args.latency_distribution,
+                   error_rate=args.error_rate,
+                   not_found_rate=args.not_found_rate,
+                   drop_rate=args.drop_rate,
+                   rate_limit=args.rate_limit,
+                   seed=args.seed)
+    print("Listening on port {}".format(args.port), file=sys.stderr)
+    web.run_app(mock.make_app(), port=args.port, print=None)
+
+if __name__ == '__main__':
+    main()
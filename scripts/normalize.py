@@ -0,0 +1,65 @@
+# Splits the parallel participant_*/gun_* columns of stage2/stage3 data into one row per participant or gun,
+# using pyarrow compute kernels instead of per-row Python. Like columnar.py, this needs pyarrow.
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from columnar import MAP_VALUE_TYPES, _to_array, _to_map_array
+
+PARTICIPANT_COLUMNS = [
+    'participant_age',
+    'participant_age_group',
+    'participant_gender',
+    'participant_name',
+    'participant_relationship',
+    'participant_status',
+    'participant_type',
+]
+
+GUN_COLUMNS = [
+    'gun_stolen',
+    'gun_type',
+]
+
+def _explode(df, columns, prefix, id_name):
+    names = [column[len(prefix):] for column in columns]
+    incident_ids = df['incident_id'].to_numpy()
+    parts = []
+    for column, name in zip(columns, names):
+        # Reuse the Parquet conversion: a map array's keys and items are the exploded ids and values.
+        mapping = _to_map_array(_to_array(df[column], pa.string()), MAP_VALUE_TYPES[column])
+        parents = np.repeat(np.arange(len(mapping)), np.diff(mapping.offsets.to_numpy()))
+        index = pd.MultiIndex.from_arrays([incident_ids[parents], mapping.keys.to_numpy()],
+                                          names=['incident_id', id_name])
+        parts.append(pd.Series(mapping.items.to_pandas().array, index=index, name=name))
+
+    table = pd.concat(parts, axis=1).reindex(columns=names)
+    return table.sort_index().reset_index()
+
+def explode_participants(df):
+    # One row per (incident_id, participant_id), with columns age, age_group, gender, name, relationship,
+    # status and type.
+    participants = _explode(df, PARTICIPANT_COLUMNS, 'participant_', 'participant_id')
+    participants['age'] = participants['age'].astype('Int32')
+    return participants
+
+def explode_guns(df):
+    # One row per (incident_id, gun_id), with columns stolen and type.
+    return _explode(df, GUN_COLUMNS, 'gun_', 'gun_id')
+
+def load_normalized(csv_fname):
+    # Reads just the columns we need from a stage2/stage3 CSV and returns (participants, guns).
+    df = pd.read_csv(csv_fname,
+                     usecols=['incident_id', *PARTICIPANT_COLUMNS, *GUN_COLUMNS],
+                     dtype=str,
+                     keep_default_na=False,
+                     na_values=[''],
+                     encoding='utf-8')
+    df['incident_id'] = df['incident_id'].astype(int)
+    return explode_participants(df), explode_guns(df)
+
+def write_normalized(df, participants_fname, guns_fname, header=True):
+    mode = 'w' if header else 'a'
+    explode_participants(df).to_csv(participants_fname, mode=mode, header=header, index=False, encoding='utf-8')
+    explode_guns(df).to_csv(guns_fname, mode=mode, header=header, index=False, encoding='utf-8')
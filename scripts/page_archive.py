@@ -0,0 +1,89 @@
+import mmap
+import numpy as np
+import os
+import threading
+import time
+import zlib
+
+from glob import glob
+
+# Each writer appends zlib-compressed pages to its own NAME.pack and, for each page, an INDEX_DTYPE record to
+# NAME.idx saying where in NAME.pack it is. Writers never share files, so any number can fill one archive at once.
+# Names start with the time the writer was opened, so sorting them puts newer copies of a page last.
+INDEX_DTYPE = np.dtype([('incident_id', '<i8'), ('offset', '<u8'), ('length', '<u4')])
+
+class PageArchiveWriter(object):
+    def __init__(self, root, compression_level=6):
+        self.root = root
+        self.compression_level = compression_level
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        name = os.path.join(self.root, '{}.{}'.format(time.time_ns(), os.getpid()))
+        self._pack_file = open(name + '.pack', 'wb')
+        self._index_file = open(name + '.idx', 'wb')
+        self._offset = 0
+        self._lock = threading.Lock()
+        return self
+
+    def __exit__(self, type, value, tb):
+        try:
+            self._pack_file.close()
+        finally:
+            self._index_file.close()
+
+    def put(self, incident_id, text):
+        # Safe to call from several threads at once, e.g. through run_in_executor().
+        data = zlib.compress(text.encode('utf-8'), self.compression_level)
+        with self._lock:
+            self._pack_file.write(data)
+            # The page has to be in the pack before the index points at it, and the index record is flushed
+            # right away, so a writer that's killed loses at most the page it was writing.
+            self._pack_file.flush()
+            record = np.array((incident_id, self._offset, len(data)), dtype=INDEX_DTYPE)
+            self._index_file.write(record.tobytes())
+            self._index_file.flush()
+            self._offset += len(data)
+
+def _map(fname):
+    with open(fname, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+class PageArchive(object):
+    # Reads the pages every writer has put in `root`. Both the indexes and the packs are mmapped, so opening an
+    # archive costs one sort of the incident ids, and pages are only read from disk when they're asked for.
+    def __init__(self, root):
+        self.root = root
+        self._packs = []
+        indexes = []
+        for index_fname in sorted(glob(os.path.join(root, '*.idx'))):
+            index_map = _map(index_fname)
+            # A writer that was killed may have left half a record at the end.
+            indexes.append(np.frombuffer(index_map, dtype=INDEX_DTYPE, count=len(index_map) // INDEX_DTYPE.itemsize))
+            self._packs.append(os.path.splitext(index_fname)[0] + '.pack')
+
+        index = np.concatenate([np.empty(0, INDEX_DTYPE), *indexes])
+        packnos = np.repeat(np.arange(len(indexes)), [len(part) for part in indexes])
+        # Stable, so that copies of a page stay in the order they were written and the last one is the newest.
+        order = np.argsort(index['incident_id'], kind='stable')
+        self._ids = index['incident_id'][order]
+        self._offsets = index['offset'][order]
+        self._lengths = index['length'][order]
+        self._packnos = packnos[order]
+        self._pack_maps = {}
+
+    def incident_ids(self):
+        return np.unique(self._ids)
+
+    def get(self, incident_id):
+        # Returns the newest copy of the incident's page, or None if it isn't in the archive.
+        i = np.searchsorted(self._ids, incident_id, side='right') - 1
+        if i < 0 or self._ids[i] != incident_id:
+            return None
+        packno = int(self._packnos[i])
+        if packno not in self._pack_maps:
+            self._pack_maps[packno] = _map(self._packs[packno])
+        offset, length = int(self._offsets[i]), int(self._lengths[i])
+        return zlib.decompress(self._pack_maps[packno][offset:offset + length]).decode('utf-8')
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# stages 1-3 in one pass: incidents scraped from each query results page go straight to the incident page
+# fetchers, and the finished rows are written out in date order, as stage3.py would have merged them.
+# Query pages, incident pages and writing all overlap, instead of each stage waiting for the last to finish.
+#
+#   pipeline.py 1-1-2018 3-31-2018 -o 2018q1.csv
+
+import asyncio
+import csv
+import dateutil.parser as dateparser
+import logging as log
+import pandas as pd
+import sys
+
+from aiohttp import TCPConnector
+from argparse import ArgumentParser
+
+from async_utils import ordered_map
+from http_cache import cache_from_args
+from metrics import add_metrics_arguments, exporter_from_args
+from rate_limiter import limiter_from_args
+from stage1 import days_between, query_with_http
+from stage1_serializer import HEADER, PARSERS, Stage1PageFetcher
+from stage2 import SCHEMA, add_session_arguments, extract_id, fill_row, open_session
+from stage2_extractor import ALL_FIELD_NAMES
+from stage2_serializer import Stage2Serializer
+
+COLUMNS = ['incident_id', *HEADER, 'incident_url_fields_missing', *ALL_FIELD_NAMES]
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'start_date',
+        metavar='START',
+        help="set start date",
+        action='store',
+    )
+    parser.add_argument(
+        'end_date',
+        metavar='END',
+        help="set end date",
+        action='store',
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help="write the finished rows to FILE, in the same format as stage3.csv (default: pipeline.csv)",
+        action='store',
+        dest='output_fname',
+        default='pipeline.csv',
+    )
+    parser.add_argument(
+        '-i', '--intermediate',
+        help="also write stage1.MM.YYYY.csv and stage2.MM.YYYY.csv for each month, as stage1.py and stage2.py would",
+        action='store_true',
+        dest='intermediate',
+    )
+    parser.add_argument(
+        '--query-parser',
+        help="set the HTML parser used to scrape query pages (default: html5lib)",
+        action='store',
+        dest='query_parser',
+        choices=sorted(PARSERS),
+        default='html5lib',
+    )
+    parser.add_argument(
+        '-d', '--debug',
+        help="show debug information",
+        action='store_const',
+        dest='log_level',
+        const=log.DEBUG,
+        default=log.WARNING,
+    )
+    add_session_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    args.cache = cache_from_args(parser, args)
+    return args
+
+class MonthlyFiles(object):
+    # Hands rows, which arrive in date order, to one writer per month, finishing each month's file as soon as
+    # the rows move on to the next month.
+    def __init__(self, open_month):
+        self._open_month = open_month
+        self._month = None
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self._writer:
+            self._writer.__exit__(type, value, tb)
+
+    def write_row(self, date, row):
+        month = (date.month, date.year)
+        if month != self._month:
+            self.__exit__(None, None, None)
+            self._month = month
+            self._writer = self._open_month(*month).__enter__()
+        self._writer.write_row(row)
+
+class Stage1File(object):
+    def __init__(self, output_fname, encoding='utf-8'):
+        self._output_fname = output_fname
+        self._encoding = encoding
+
+    def __enter__(self):
+        self._output_file = open(self._output_fname, 'w', encoding=self._encoding)
+        self._writer = csv.writer(self._output_file)
+        self._writer.writerow(HEADER)
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._output_file.__exit__(type, value, tb)
+
+    def write_row(self, info):
+        self._writer.writerow([*info])
+
+def open_stage1(month, year):
+    return Stage1File('stage1.{:02d}.{:04d}.csv'.format(month, year))
+
+def open_stage2(month, year):
+    return Stage2Serializer('stage2.{:02d}.{:04d}.csv'.format(month, year), COLUMNS, dtype=SCHEMA)
+
+async def run(args, days, limiter, connector, stage1_files, stage2_files):
+    n_failed_pages = 0
+
+    async def page_urls():
+        # The same pages, in the same order, that Stage1Serializer.write_batch would queue up.
+        async for day, query_url, n_pages in query_with_http(args, days, limiter):
+            for pageno in range(n_pages - 1, 0, -1):
+                yield '{}?page={}'.format(query_url, pageno)
+            if n_pages > 0:
+                yield query_url
+
+    async def stage1_rows(pages):
+        nonlocal n_failed_pages
+        async for infos in pages:
+            if infos is None:
+                # Already logged by the fetcher.
+                n_failed_pages += 1
+                continue
+            for info in infos:
+                row = dict(zip(HEADER, info))
+                # stage2.py reads stage1 files with parse_dates=['date'], and extract_id() the ids.
+                row['date'] = pd.Timestamp(row['date'])
+                row['incident_id'] = extract_id(row['incident_url'])
+                if stage1_files:
+                    stage1_files.write_row(row['date'], info)
+                yield row
+
+    async def process(row):
+        return await fill_row(session, row)
+
+    async with Stage1PageFetcher(cache=args.cache,
+                                 parser=args.query_parser,
+                                 workers=args.conn_limit,
+                                 limiter=limiter,
+                                 connector=connector,
+                                 proxy=args.proxy) as fetcher, \
+               open_session(args) as session:
+        with Stage2Serializer(args.output_fname, COLUMNS, dtype=SCHEMA) as output:
+            pages = fetcher.read_pages(page_urls())
+            async for row in ordered_map(process, stage1_rows(pages), workers=args.conn_limit):
+                output.write_row(row)
+                if stage2_files:
+                    stage2_files.write_row(row['date'], row)
+
+    return n_failed_pages
+
+async def main():
+    args = parse_args()
+    log.basicConfig(level=args.log_level)
+
+    global_start, global_end = dateparser.parse(args.start_date), dateparser.parse(args.end_date)
+    days = days_between(global_start, global_end)
+    limiter = limiter_from_args(args)
+    connector = TCPConnector(limit_per_host=args.conn_limit)
+
+    async with exporter_from_args(args, 'pipeline'):
+        try:
+            if args.intermediate:
+                with MonthlyFiles(open_stage1) as stage1_files, MonthlyFiles(open_stage2) as stage2_files:
+                    n_failed_pages = await run(args, days, limiter, connector, stage1_files, stage2_files)
+            else:
+                n_failed_pages = await run(args, days, limiter, connector, None, None)
+        finally:
+            await connector.close()
+
+    if n_failed_pages:
+        print("{} query pages couldn't be read, so their incidents are missing from {}".format(
+            n_failed_pages, args.output_fname), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
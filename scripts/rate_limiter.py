@@ -0,0 +1,120 @@
+import asyncio
+import logging as log
+import sys
+
+from collections import deque
+
+import metrics
+
+class AdaptiveLimiter(object):
+    # Controls how many requests may be in flight at once using AIMD (additive increase, multiplicative decrease).
+    # Every healthy response grows the limit by 1/limit, i.e. by about 1 per round of requests. Server errors,
+    # timeouts and dropped connections cut it by `decrease_factor`, at most once per round trip so a burst of
+    # failures from the same round only counts once. Latency more than `latency_tolerance` times the best latency
+    # seen so far counts as unhealthy and stops the limit from growing.
+    def __init__(self, initial=4, minimum=1, maximum=20, decrease_factor=0.5, latency_tolerance=3.0, rate_window=10.0):
+        assert minimum <= initial <= maximum
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.rate_window = rate_window
+
+        self._in_flight = 0
+        self._waiters = []
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._min_latency = None
+        self._avg_latency = None
+        self._completions = deque()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def rate(self):
+        # Responses per second over the last `rate_window` seconds.
+        self._expire_completions(asyncio.get_event_loop().time())
+        return len(self._completions) / self.rate_window
+
+    def __str__(self):
+        return "concurrency target {}, {} in flight, {:.1f} req/s".format(int(self.limit), self._in_flight, self.rate)
+
+    def _expire_completions(self, now):
+        while self._completions and self._completions[0] < now - self.rate_window:
+            self._completions.popleft()
+
+    async def acquire(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            delay = self._paused_until - loop.time()
+            if delay > 0:
+                # The server asked us to back off (Retry-After), so nobody gets a slot until then.
+                await asyncio.sleep(delay)
+                continue
+            if self._in_flight < int(self.limit):
+                self._in_flight += 1
+                self._update_gauges()
+                return loop.time()
+
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            self._update_gauges()
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self, start, ok, retry_after=None):
+        # `start` is the value returned by the matching acquire(). `ok` is None if the outcome says nothing
+        # about the server's health (e.g. the request was cancelled on our end).
+        now = asyncio.get_event_loop().time()
+        latency = now - start
+
+        self._in_flight -= 1
+        self._completions.append(now)
+        self._expire_completions(now)
+
+        if ok:
+            self._record_latency(latency)
+            if self._avg_latency <= self.latency_tolerance * self._min_latency:
+                old_limit = int(self.limit)
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                if int(self.limit) > old_limit:
+                    log.debug("Raising %s", self)
+        elif ok is not None:
+            if now - self._last_decrease > (self._avg_latency or latency):
+                self._last_decrease = now
+                old_limit = int(self.limit)
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                if int(self.limit) < old_limit:
+                    print("Backing off: {}".format(self), file=sys.stderr)
+
+        if retry_after is not None:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.set_gauge('limiter_limit', int(self.limit))
+        metrics.set_gauge('limiter_in_flight', self._in_flight)
+        metrics.set_gauge('limiter_waiting', len(self._waiters))
+
+    def _record_latency(self, latency):
+        if self._min_latency is None:
+            self._min_latency = self._avg_latency = latency
+            return
+        self._min_latency = min(self._min_latency, latency)
+        self._avg_latency = 0.8 * self._avg_latency + 0.2 * latency
+
+def limiter_from_args(args):
+    if not args.adaptive:
+        return None
+    return AdaptiveLimiter(initial=max(1, args.conn_limit // 4), maximum=args.conn_limit)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# rebuilds stage2 files from the incident pages saved by stage2.py --archive, without crawling again, e.g. after
+# the extractor changes. Parsing is spread over a process pool, so this is limited only by the number of CPUs.
+#
+#   stage2.py 01-2018 --archive pages       # saves the pages while crawling
+#   reextract.py pages stage1.*.csv -j 8    # rewrites stage2.MM.YYYY.csv for every stage1.MM.YYYY.csv
+
+import asyncio
+import os
+import pandas as pd
+import sys
+import time
+import traceback as tb
+
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import add_metrics_arguments, exporter_from_args, observe
+from page_archive import PageArchive
+from stage2 import SCHEMA, add_incident_id
+from stage2_extractor import ALL_FIELD_NAMES, EXTRACTORS, NIL_FIELDS
+from stage2_serializer import Stage2Serializer
+from stage2_session import Context
+
+# Incidents handed to a worker process at a time. Large enough that pickling the batches costs little next to
+# parsing them.
+BATCH_SIZE = 200
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'archive_dir',
+        metavar='ARCHIVE',
+        help="directory the pages were saved to with stage2.py --archive",
+    )
+    parser.add_argument(
+        'input_fnames',
+        metavar='INPUT',
+        nargs='+',
+        help="stage1 files to rebuild the stage2 files of. the output for stage1.MM.YYYY.csv is written to stage2.MM.YYYY.csv",
+    )
+    parser.add_argument(
+        '-p', '--parser',
+        help="set the HTML parser used to scrape incident pages (default: html5lib)",
+        action='store',
+        dest='parser',
+        choices=sorted(EXTRACTORS),
+        default='html5lib',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='NUM',
+        help="parse pages in NUM worker processes (default: number of CPUs)",
+        action='store',
+        dest='jobs',
+        type=int,
+        default=os.cpu_count(),
+    )
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    if not os.path.isdir(args.archive_dir):
+        parser.error("{} isn't a directory".format(args.archive_dir))
+    for input_fname in args.input_fnames:
+        if not os.path.basename(input_fname).startswith('stage1.'):
+            parser.error("{} isn't named like a stage1 file (stage1.MM.YYYY.csv)".format(input_fname))
+    return args
+
+def output_fname(input_fname):
+    dirname, basename = os.path.split(input_fname)
+    return os.path.join(dirname, 'stage2.' + basename[len('stage1.'):])
+
+# The archive and extractor used by each worker process. They're created once per process by _init_worker().
+_worker_archive = None
+_worker_extractor = None
+
+def _init_worker(archive_dir, parser):
+    global _worker_archive, _worker_extractor
+    _worker_archive = PageArchive(archive_dir)
+    _worker_extractor = EXTRACTORS[parser]()
+
+def _extract_batch(batch):
+    # Returns each incident's fields, or None if its page isn't archived or couldn't be parsed, and the time
+    # spent parsing.
+    start = time.perf_counter()
+    results = []
+    for incident_id, incident_url, ctx in batch:
+        text = _worker_archive.get(incident_id)
+        if text is None:
+            results.append(None)
+            continue
+        try:
+            results.append(_worker_extractor.extract_fields(text, ctx))
+        except Exception:
+            print("ERROR! Extraction failed for the following url: {}".format(incident_url), file=sys.stderr)
+            tb.print_exc()
+            results.append(None)
+    return results, time.perf_counter() - start
+
+def load_rows(input_fname):
+    df = pd.read_csv(input_fname,
+                     dtype=SCHEMA,
+                     parse_dates=['date'],
+                     encoding='utf-8')
+    df = add_incident_id(df)
+    columns = [*df.columns, 'incident_url_fields_missing', *ALL_FIELD_NAMES]
+    return columns, df.to_dict('records')
+
+def submit(executor, input_fname):
+    columns, rows = load_rows(input_fname)
+    batches = []
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch = [(int(row['incident_id']),
+                  row['incident_url'],
+                  Context(address=row['address'], city_or_county=row['city_or_county'], state=row['state']))
+                 for row in rows[start:start + BATCH_SIZE]]
+        batches.append(executor.submit(_extract_batch, batch))
+    return input_fname, columns, rows, batches
+
+async def write_output(input_fname, columns, rows, batches, parser):
+    n_missing = 0
+    rows = iter(rows)
+    with Stage2Serializer(output_fname(input_fname), columns, dtype=SCHEMA) as serializer:
+        for batch in batches:
+            results, elapsed = await asyncio.wrap_future(batch)
+            observe('parse_seconds', elapsed, parser=parser)
+            for fields, row in zip(results, rows):
+                # The same as stage2.fill_row(), for pages that were crawled.
+                row['incident_url_fields_missing'] = fields is None
+                row.update(NIL_FIELDS if fields is None else fields)
+                serializer.write_row(row)
+                n_missing += fields is None
+    print("Wrote {} ({} incidents weren't archived or couldn't be parsed)".format(
+        output_fname(input_fname), n_missing), file=sys.stderr)
+
+async def main():
+    args = parse_args()
+
+    async with exporter_from_args(args, 'reextract'):
+        with ProcessPoolExecutor(max_workers=args.jobs,
+                                 initializer=_init_worker,
+                                 initargs=(args.archive_dir, args.parser)) as executor:
+            # Keep the next file's pages queued up while this one is written, so the workers never wait on us.
+            # No more than two files' rows are held at once.
+            pending = deque()
+            for input_fname in args.input_fnames:
+                pending.append(submit(executor, input_fname))
+                if len(pending) > 1:
+                    await write_output(*pending.popleft(), args.parser)
+            while pending:
+                await write_output(*pending.popleft(), args.parser)
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
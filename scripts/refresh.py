@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# refreshing stage2 data: re-checking incident pages for edits GVA made after they were scraped,
+# and writing the rows that changed to a delta file
+
+import asyncio
+import hashlib
+import sys
+import traceback as tb
+
+from aiohttp.client_exceptions import ClientResponseError
+from argparse import ArgumentParser
+from collections import Counter
+from glob import glob
+
+from async_utils import ordered_map
+from http_cache import cache_from_args
+from metrics import add_metrics_arguments, exporter_from_args
+from refresh_state import PageState, RefreshState
+from repair import MISSING_COLUMN, format_row, iter_rows_with_offsets, patch_file
+from stage2 import add_session_arguments, open_session
+from stage3 import STAGE2_GLOB
+
+UPDATED = 'updated'
+REMOVED = 'removed'
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'csv_fnames',
+        metavar='FILE',
+        nargs='*',
+        help="stage2 files to refresh (default: every file matching {})".format(STAGE2_GLOB),
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help="append changed rows to FILE, with an extra leading 'change' column (default: delta.csv)",
+        action='store',
+        dest='delta_fname',
+        default='delta.csv',
+    )
+    parser.add_argument(
+        '--state',
+        metavar='FILE',
+        help="remember each page's ETag, Last-Modified and content hash in FILE between runs (default: refresh.sqlite)",
+        action='store',
+        dest='state_fname',
+        default='refresh.sqlite',
+    )
+    parser.add_argument(
+        '--since',
+        metavar='YYYY-MM-DD',
+        help="only check incidents that happened on or after this date",
+        action='store',
+        dest='since',
+        default='',
+    )
+    parser.add_argument(
+        '--apply',
+        help="also patch the changes into the stage2 files in place",
+        action='store_true',
+        dest='apply',
+    )
+    add_session_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    args.cache = cache_from_args(parser, args)
+    args.csv_fnames = args.csv_fnames or sorted(glob(STAGE2_GLOB))
+    return args
+
+def find_rows(csv_fname, since):
+    with open(csv_fname, 'rb') as csv_file:
+        data = csv_file.read()
+
+    rows = iter_rows_with_offsets(data)
+    _, header_end, header = next(rows)
+    lineterminator = '\r\n' if data[:header_end].endswith(b'\r\n') else '\n'
+    missing_index = header.index(MISSING_COLUMN)
+    date_index = header.index('date')
+    # Rows that are missing fields are repair.py's job.
+    for start, end, row in rows:
+        if row[missing_index] != 'True' and row[date_index] >= since:
+            yield csv_fname, header, lineterminator, start, end, data[start:end], dict(zip(header, row))
+
+def find_all_rows(csv_fnames, since):
+    # One file at a time, so only the file being checked is held in memory.
+    for csv_fname in csv_fnames:
+        yield from find_rows(csv_fname, since)
+
+async def refresh(args, items, state, delta_file):
+    async def check(item):
+        csv_fname, header, lineterminator, start, end, raw, row = item
+        old_state = known.get(int(row['incident_id']))
+        try:
+            result = await session.get_if_modified(row['incident_url'], *(old_state[:2] if old_state else ()))
+            if result is None:
+                return 'not_modified', None, None
+
+            text, etag, last_modified = result
+            new_state = PageState(etag, last_modified, hashlib.sha256(text.encode('utf-8')).hexdigest())
+            if old_state and old_state.sha256 == new_state.sha256:
+                return 'same_content', None, new_state
+
+            # The page is new to us or has changed, but that doesn't mean any of our fields have.
+            new_row = dict(row)
+            new_row.update(await session.extract_fields(row, text))
+            new_row[MISSING_COLUMN] = False
+            replacement = format_row(new_row, header, lineterminator)
+            return (UPDATED if replacement != raw else 'same_fields'), replacement, new_state
+        except ClientResponseError as exc:
+            if exc.status == 404:
+                return REMOVED, b'', None
+            print("ERROR! Refresh failed for the following url: {}".format(row['incident_url']), file=sys.stderr)
+            return 'failed', None, None
+        except Exception:
+            print("ERROR! Refresh failed for the following url: {}".format(row['incident_url']), file=sys.stderr)
+            tb.print_exc()
+            return 'failed', None, None
+
+    async def process(item):
+        return item, await check(item)
+
+    def finish(csv_fname, patches, states, removed_ids):
+        if args.apply:
+            patch_file(csv_fname, patches)
+        # Only now that the file's changes are written down can we remember the pages as seen. Otherwise a run
+        # that dies partway through would get 304s for them next time, and their changes would be lost.
+        delta_file.flush()
+        state.record(states)
+        state.forget(removed_ids)
+
+    known = state.load()
+    counts = Counter()
+    current_fname, patches, states, removed_ids = None, [], [], []
+    async with open_session(args) as session:
+        async for item, (outcome, replacement, new_state) in ordered_map(process, items, workers=args.conn_limit):
+            csv_fname, header, lineterminator, start, end, raw, row = item
+            if csv_fname != current_fname:
+                if current_fname:
+                    finish(current_fname, patches, states, removed_ids)
+                current_fname, patches, states, removed_ids = csv_fname, [], [], []
+                if not delta_file.tell():
+                    delta_file.write((','.join(['change', *header]) + lineterminator).encode('utf-8'))
+
+            counts[outcome] += 1
+            if outcome == UPDATED:
+                delta_file.write(b'updated,' + replacement)
+                patches.append((start, end, replacement))
+            elif outcome == REMOVED:
+                delta_file.write(b'removed,' + raw)
+                patches.append((start, end, replacement))
+                removed_ids.append(row['incident_id'])
+
+            if new_state:
+                states.append((row['incident_id'], new_state))
+    if current_fname:
+        finish(current_fname, patches, states, removed_ids)
+    return counts
+
+async def main():
+    args = parse_args()
+
+    print("Checking {} files".format(len(args.csv_fnames)), file=sys.stderr)
+
+    async with exporter_from_args(args, 'refresh'):
+        # Appended to rather than overwritten: the pages in it are remembered as seen, so a later run won't
+        # report their changes again.
+        with RefreshState(args.state_fname) as state, open(args.delta_fname, 'ab') as delta_file:
+            counts = await refresh(args, find_all_rows(args.csv_fnames, args.since), state, delta_file)
+
+    print("{not_modified} not modified, {same_content} with the same content, {same_fields} with the same fields, "
+          "{updated} updated, {removed} removed, {failed} failed".format(**{
+              outcome: counts[outcome]
+              for outcome in ('not_modified', 'same_content', 'same_fields', UPDATED, REMOVED, 'failed')
+          }), file=sys.stderr)
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
@@ -0,0 +1,35 @@
+import sqlite3
+import time
+
+from collections import namedtuple
+
+PageState = namedtuple('PageState', ['etag', 'last_modified', 'sha256'])
+
+class RefreshState(object):
+    def __init__(self, fname):
+        self._fname = fname
+
+    def __enter__(self):
+        self._conn = sqlite3.connect(self._fname)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS pages (incident_id INTEGER PRIMARY KEY, etag TEXT, last_modified TEXT, sha256 TEXT, checked REAL)')
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._conn.close()
+
+    def load(self):
+        # {incident_id: PageState} for every page seen by a previous refresh.
+        rows = self._conn.execute('SELECT incident_id, etag, last_modified, sha256 FROM pages')
+        return {incident_id: PageState(*rest) for incident_id, *rest in rows}
+
+    def record(self, pages):
+        # pages is a list of (incident_id, PageState) for pages that were downloaded.
+        now = time.time()
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                                   [(int(id), *state, now) for id, state in pages])
+
+    def forget(self, incident_ids):
+        with self._conn:
+            self._conn.executemany('DELETE FROM pages WHERE incident_id = ?', [(int(id),) for id in incident_ids])
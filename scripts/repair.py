@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# repairing stage2 files: re-fetching only the incidents whose incident_url_fields_missing is set,
+# and patching them into the files in place
+
+import asyncio
+import csv
+import os
+import pandas as pd
+import sys
+
+from aiohttp.client_exceptions import ClientResponseError
+from argparse import ArgumentParser
+from glob import glob
+
+from async_utils import ordered_map
+from http_cache import cache_from_args
+from metrics import add_metrics_arguments, exporter_from_args
+from stage2 import SCHEMA, add_session_arguments, open_session
+from stage3 import STAGE2_GLOB
+
+MISSING_COLUMN = 'incident_url_fields_missing'
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'csv_fnames',
+        metavar='FILE',
+        nargs='*',
+        help="stage2 files to repair (default: every file matching {})".format(STAGE2_GLOB),
+    )
+    add_session_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    args.cache = cache_from_args(parser, args)
+    args.csv_fnames = args.csv_fnames or sorted(glob(STAGE2_GLOB))
+    return args
+
+def iter_rows_with_offsets(data, encoding='utf-8'):
+    # Yields (start, end, row) for every record, where start and end are byte offsets into data.
+    # Quoted fields may span lines, so let the csv module decide where each record ends.
+    consumed = []
+    def iter_lines():
+        for line in data.splitlines(keepends=True):
+            consumed.append(len(line))
+            yield line.decode(encoding)
+
+    offset = 0
+    for row in csv.reader(iter_lines()):
+        start, offset = offset, offset + sum(consumed)
+        consumed.clear()
+        yield start, offset, row
+
+def find_broken_rows(csv_fname):
+    with open(csv_fname, 'rb') as csv_file:
+        data = csv_file.read()
+    # Most files have nothing to repair, and can be ruled out without parsing them.
+    if b'True' not in data:
+        return []
+
+    rows = iter_rows_with_offsets(data)
+    _, header_end, header = next(rows)
+    lineterminator = '\r\n' if data[:header_end].endswith(b'\r\n') else '\n'
+    missing_index = header.index(MISSING_COLUMN)
+    return [(csv_fname, header, lineterminator, start, end, dict(zip(header, row)))
+            for start, end, row in rows
+            if row[missing_index] == 'True']
+
+def format_row(row, header, lineterminator):
+    # Same formatting as Stage2Serializer, so a repaired row looks like it was never broken.
+    df = pd.DataFrame.from_records([row], columns=header).astype(SCHEMA)
+    return df.to_csv(header=False,
+                     index=False,
+                     float_format='%g',
+                     lineterminator=lineterminator).encode('utf-8')
+
+def patch_file(csv_fname, patches):
+    # patches is a list of (start, end, replacement) in file order. Everything before the first
+    # patched row is left alone; only the rest of the file is rewritten.
+    if not patches:
+        return
+
+    first = patches[0][0]
+    with open(csv_fname, 'r+b') as csv_file:
+        csv_file.seek(first)
+        tail = csv_file.read()
+        pieces = []
+        pos = first
+        for start, end, replacement in patches:
+            pieces.append(tail[pos - first:start - first])
+            pieces.append(replacement)
+            pos = end
+        pieces.append(tail[pos - first:])
+
+        csv_file.seek(first)
+        csv_file.write(b''.join(pieces))
+        csv_file.truncate()
+        csv_file.flush()
+        os.fsync(csv_file.fileno())
+
+async def repair(args, broken_rows):
+    async def process(item):
+        csv_fname, header, lineterminator, start, end, row = item
+        try:
+            fields = await session.get_fields_from_incident_url(row)
+        except ClientResponseError as exc:
+            if exc.status == 404:
+                # Same as stage2 --amend: the incident is gone, so drop the row.
+                return csv_fname, (start, end, b'')
+            return csv_fname, None
+        except Exception:
+            # Already logged by the session. Leave the row as-is for the next sweep.
+            return csv_fname, None
+
+        row.update(fields)
+        row[MISSING_COLUMN] = False
+        return csv_fname, (start, end, format_row(row, header, lineterminator))
+
+    def finish(csv_fname, patches, n_broken):
+        patch_file(csv_fname, patches)
+        n_removed = sum(1 for patch in patches if not patch[2])
+        print("{}: repaired {} of {} rows, removed {}".format(
+              csv_fname, len(patches) - n_removed, n_broken, n_removed), file=sys.stderr)
+
+    # Rows come back in input order, i.e. grouped by file, so each file is patched as soon as its
+    # last row is done and an interrupted sweep keeps what it already repaired.
+    current_fname, patches, n_broken = None, [], 0
+    async with open_session(args) as session:
+        async for csv_fname, patch in ordered_map(process, broken_rows, workers=args.conn_limit):
+            if csv_fname != current_fname:
+                if current_fname:
+                    finish(current_fname, patches, n_broken)
+                current_fname, patches, n_broken = csv_fname, [], 0
+            n_broken += 1
+            if patch:
+                patches.append(patch)
+    if current_fname:
+        finish(current_fname, patches, n_broken)
+
+async def main():
+    args = parse_args()
+
+    broken_rows = []
+    for csv_fname in args.csv_fnames:
+        broken_rows.extend(find_broken_rows(csv_fname))
+    print("Found {} rows to repair in {} files".format(len(broken_rows), len(args.csv_fnames)), file=sys.stderr)
+
+    async with exporter_from_args(args, 'repair'):
+        await repair(args, broken_rows)
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
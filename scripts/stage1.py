@@ -4,12 +4,13 @@
 import asyncio
 import dateutil.parser as dateparser
 import logging as log
-import platform
+import re
 import sys
 import warnings
 
 import selenium_utils
 
+from aiohttp import TCPConnector
 from argparse import ArgumentParser
 from calendar import monthrange
 from datetime import date, timedelta
@@ -21,21 +22,28 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from urllib.parse import parse_qs, urlparse
 
-from stage1_serializer import Stage1Serializer
+from async_utils import ordered_map
+from http_cache import add_cache_arguments, cache_from_args
+from metrics import add_metrics_arguments, exporter_from_args
+from rate_limiter import limiter_from_args
+from stage1_client import DATE_FORMAT, MESSAGE_NO_INCIDENTS_AVAILABLE, Stage1Client
+from stage1_serializer import PARSERS, Stage1PageFetcher, Stage1Serializer, refetch_failed
 
-# Formats as %m/%d/%Y, but does not leave leading zeroes on the month or day.
-# Surprisingly, the syntax for this is different across platforms: https://stackoverflow.com/a/2073189/4077294
-DATE_FORMAT = '%#m/%#d/%Y' if platform.system() == 'Windows' else '%-m/%-d/%Y'
+MONTH_PATTERN = re.compile(r'(\d{1,2})-(\d{4})')
 
-MESSAGE_NO_INCIDENTS_AVAILABLE = 'There are currently no incidents available.'
+def parse_month(arg):
+    match = MONTH_PATTERN.fullmatch(arg) # e.g. '02-2014'
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    return None
 
 def parse_args():
-    targets_specific_month = False
-    if len(sys.argv) > 1:
-        parts = sys.argv[1].split('-')
-        if len(parts) == 2: # e.g. '02-2014'
-            targets_specific_month = True
-            del sys.argv[1]
+    months = []
+    # Accept either a single month or a range of months, e.g. '02-2014' or '02-2014 03-2018'.
+    while len(sys.argv) > 1 and len(months) < 2 and parse_month(sys.argv[1]):
+        months.append(parse_month(sys.argv[1]))
+        del sys.argv[1]
+    targets_specific_month = len(months) > 0
 
     parser = ArgumentParser()
     if not targets_specific_month:
@@ -54,8 +62,15 @@ def parse_args():
         parser.add_argument(
             'output_file',
             metavar='OUTFILE',
-            help="set output file",
+            help="set output file. may be omitted if --by-month is given",
             action='store',
+            nargs='?',
+        )
+        parser.add_argument(
+            '-m', '--by-month',
+            help="write each month's incidents to its own file, stage1.MM.YYYY.csv",
+            action='store_true',
+            dest='by_month',
         )
 
     parser.add_argument(
@@ -66,17 +81,73 @@ def parse_args():
         const=log.DEBUG,
         default=log.WARNING,
     )
+    parser.add_argument(
+        '-p', '--parser',
+        help="set the HTML parser used to scrape query pages (default: html5lib)",
+        action='store',
+        dest='parser',
+        choices=sorted(PARSERS),
+        default='html5lib',
+    )
+    parser.add_argument(
+        '-l', '--limit',
+        metavar='NUM',
+        help="limit the number of simultaneous connections aiohttp makes to gunviolencearchive.org",
+        action='store',
+        dest='conn_limit',
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        '--adaptive',
+        help="adjust the number of simultaneous connections to how the server is coping, up to the --limit",
+        action='store_true',
+        dest='adaptive',
+    )
+    parser.add_argument(
+        '--refetch-failed',
+        help="instead of querying, fetch the pages listed in each output file's .failed file again and fill in their rows",
+        action='store_true',
+        dest='refetch_failed',
+    )
+    parser.add_argument(
+        '--selenium',
+        help="run queries by driving Chrome through the query form, one day at a time, instead of over plain HTTP",
+        action='store_true',
+        dest='selenium',
+    )
+    parser.add_argument(
+        '--proxy',
+        metavar='URL',
+        help="send every request through the HTTP proxy at URL, e.g. mock_server.py",
+        action='store',
+        dest='proxy',
+    )
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    args.cache = cache_from_args(parser, args)
+    for month, year in months:
+        if not 1 <= month <= 12:
+            parser.error("{:02d}-{:04d} isn't a month".format(month, year))
     if targets_specific_month:
-        month, year = map(int, parts)
-        end_day = monthrange(year, month)[1]
-        
-        args.start_date = '{}-01-{}'.format(month, year)
-        args.end_date = '{}-{}-{}'.format(month, end_day, year)
-        args.output_file = 'stage1.{:02d}.{:04d}.csv'.format(month, year)
+        (start_month, start_year), (end_month, end_year) = months[0], months[-1]
+        end_day = monthrange(end_year, end_month)[1]
+
+        args.start_date = '{}-01-{}'.format(start_month, start_year)
+        args.end_date = '{}-{}-{}'.format(end_month, end_day, end_year)
+        args.output_file = None
+        args.by_month = True
+    elif args.output_file is None and not args.by_month:
+        parser.error("either OUTFILE or --by-month is required")
     return args
 
+def output_fname(args, day):
+    if args.by_month:
+        return 'stage1.{:02d}.{:04d}.csv'.format(day.month, day.year)
+    return args.output_file
+
 def query(driver, start_date, end_date):
     print("Querying incidents between {:%m/%d/%Y} and {:%m/%d/%Y}".format(start_date, end_date))
 
@@ -125,24 +196,91 @@ def get_n_pages(driver):
         # A single page of results was returned.
         return 1
 
-async def main():
-    args = parse_args()
-    log.basicConfig(level=args.log_level)
+def days_between(start, end):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+async def query_with_selenium(days):
     driver = Chrome()
+    for day in days:
+        yield (day, *query(driver, day, day))
 
-    step = timedelta(days=1)
-    global_start, global_end = dateparser.parse(args.start_date), dateparser.parse(args.end_date)
-    start, end = global_start, global_start + step - timedelta(days=1)
+async def query_with_http(args, days, limiter):
+    async with Stage1Client(limiter=limiter, proxy=args.proxy, limit_per_host=args.conn_limit) as client:
+        # Query days in parallel, but hand the results back in date order.
+        async def query_day(day):
+            return (day, *await client.query(day, day))
+        async for result in ordered_map(query_day, days, workers=args.conn_limit):
+            yield result
 
-    async with Stage1Serializer(output_fname=args.output_file) as serializer:
+async def write_output(args, output_fname, batches, limiter, connector):
+    async with Stage1Serializer(output_fname=output_fname,
+                                cache=args.cache,
+                                parser=args.parser,
+                                workers=args.conn_limit,
+                                limiter=limiter,
+                                connector=connector,
+                                proxy=args.proxy) as serializer:
         serializer.write_header()
-        while start <= global_end:
-            query_url, n_pages = query(driver, start, end)
+        for query_url, n_pages in batches:
             if n_pages > 0:
                 serializer.write_batch(query_url, n_pages)
-            start, end = end + timedelta(days=1), min(global_end, end + step)
         await serializer.flush_writes()
 
+async def main():
+    args = parse_args()
+    log.basicConfig(level=args.log_level)
+
+    global_start, global_end = dateparser.parse(args.start_date), dateparser.parse(args.end_date)
+    days = days_between(global_start, global_end)
+    # Queries and every month's pages share one limiter and one pool of connections.
+    limiter = limiter_from_args(args)
+    connector = TCPConnector(limit_per_host=args.conn_limit)
+
+    async with exporter_from_args(args, 'stage1'):
+        try:
+            if args.refetch_failed:
+                await refetch(args, days, limiter, connector)
+            else:
+                await scrape(args, days, limiter, connector)
+        finally:
+            await connector.close()
+
+async def scrape(args, days, limiter, connector):
+    results = query_with_selenium(days) if args.selenium else query_with_http(args, days, limiter)
+
+    # Results come back in date order, so once a day maps to a new output file, the previous file has all
+    # of its queries and can start fetching its pages while we keep querying.
+    writes = []
+    current_fname, batches = None, []
+    async for day, query_url, n_pages in results:
+        fname = output_fname(args, day)
+        if fname != current_fname:
+            if current_fname is not None:
+                writes.append(asyncio.ensure_future(write_output(args, current_fname, batches, limiter, connector)))
+            current_fname, batches = fname, []
+        batches.append((query_url, n_pages))
+    if current_fname is not None:
+        writes.append(asyncio.ensure_future(write_output(args, current_fname, batches, limiter, connector)))
+    await asyncio.gather(*writes)
+
+async def refetch(args, days, limiter, connector):
+    fnames = sorted(set(output_fname(args, day) for day in days))
+    async with Stage1PageFetcher(cache=args.cache,
+                                 parser=args.parser,
+                                 workers=args.conn_limit,
+                                 limiter=limiter,
+                                 connector=connector,
+                                 proxy=args.proxy) as fetcher:
+        n_missing = 0
+        for fname in fnames:
+            n_missing += await refetch_failed(fname, fetcher)
+    if n_missing:
+        print("{} pages are still missing".format(n_missing), file=sys.stderr)
+        sys.exit(1)
+
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
     try:
@@ -0,0 +1,123 @@
+import json
+import lxml.html
+import platform
+
+from aiohttp import ClientSession, CookieJar, TCPConnector
+from aiohttp.hdrs import CONTENT_TYPE
+from urllib.parse import parse_qs, urlparse
+
+from http_utils import request
+
+QUERY_URL = 'http://www.gunviolencearchive.org/query'
+
+# Formats as %m/%d/%Y, but does not leave leading zeroes on the month or day.
+# Surprisingly, the syntax for this is different across platforms: https://stackoverflow.com/a/2073189/4077294
+DATE_FORMAT = '%#m/%#d/%Y' if platform.system() == 'Windows' else '%-m/%-d/%Y'
+
+MESSAGE_NO_INCIDENTS_AVAILABLE = 'There are currently no incidents available.'
+
+def _parse(text, url):
+    root = lxml.html.document_fromstring(text)
+    root.make_links_absolute(url)
+    return root
+
+def _find_query_form(root):
+    # The query form is the one with the "execute" submit button.
+    button = next(iter(root.xpath('//*[@id="edit-actions-execute"]')), None)
+    assert button is not None, "Couldn't find the query form's submit button"
+    return button, next(button.iterancestors('form'))
+
+def _find_date_link(root):
+    # The "Date" entry in the "Add a rule" dropdown.
+    links = root.xpath('//a[normalize-space(.) = "Date"]')
+    assert links, "Couldn't find the link that adds a date rule to the query"
+    return links[0].attrib['href']
+
+def _insert_ajax_fragments(root, commands):
+    # Drupal answers AJAX requests with a list of commands. The 'insert' commands carry the HTML for the new
+    # rule, which we splice into the form so its inputs get submitted along with everything else.
+    _, form = _find_query_form(root)
+    for command in commands:
+        if command.get('command') == 'insert' and command.get('data'):
+            for fragment in lxml.html.fragments_fromstring(command['data']):
+                if not isinstance(fragment, str):
+                    form.append(fragment)
+        elif command.get('command') == 'update_build_id':
+            for input in form.xpath('.//input[@name="form_build_id"]'):
+                input.value = command['new']
+
+def _set_date_fields(form, start_date_str, end_date_str):
+    n_set = 0
+    for input in form.xpath('.//input[@id]'):
+        if input.attrib['id'].endswith('filter-field-date-from'):
+            input.value = start_date_str
+            n_set += 1
+        elif input.attrib['id'].endswith('filter-field-date-to'):
+            input.value = end_date_str
+            n_set += 1
+    assert n_set == 2, "Couldn't find the date rule's from/to fields"
+
+def get_n_pages(text):
+    root = lxml.html.document_fromstring(text)
+    last_a = next(iter(root.xpath('//a[@title="Go to last page"]')), None)
+    if last_a is not None:
+        form_data = urlparse(last_a.attrib['href']).query
+        return int(parse_qs(form_data)['page'][0]) + 1
+
+    tds = root.xpath('//*[contains(concat(" ", normalize-space(@class), " "), " responsive ")]//tbody//tr/td')
+    if len(tds) == 1 and tds[0].text_content().strip() == MESSAGE_NO_INCIDENTS_AVAILABLE:
+        # Nil query results.
+        return 0
+
+    # A single page of results was returned.
+    return 1
+
+class Stage1Client(object):
+    # Runs queries by submitting the /query form over plain HTTP, the same way a browser would.
+    def __init__(self, limiter=None, proxy=None, **kwargs):
+        self._limiter = limiter
+        self._proxy = proxy
+        self._conn_options = kwargs
+
+    async def __aenter__(self):
+        self._conn = TCPConnector(**self._conn_options)
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        await self._conn.close()
+
+    async def _gettext(self, sess, method, url, **kwargs):
+        resp = await request(sess, method, url, limiter=self._limiter, **kwargs)
+        async with resp:
+            resp.raise_for_status()
+            return str(resp.url), resp.headers.get(CONTENT_TYPE, ''), await resp.text()
+
+    async def query(self, start_date, end_date):
+        print("Querying incidents between {:%m/%d/%Y} and {:%m/%d/%Y}".format(start_date, end_date))
+
+        # Rules added to the form live in the server-side session, so every query gets its own cookies.
+        async with ClientSession(connector=self._conn,
+                                 connector_owner=False,
+                                 cookie_jar=CookieJar(unsafe=True),
+                                 proxy=self._proxy) as sess:
+            url, _, text = await self._gettext(sess, 'GET', QUERY_URL)
+            root = _parse(text, url)
+
+            # Add a date rule to the query.
+            date_url = _find_date_link(root)
+            url, ctype, text = await self._gettext(sess, 'GET', date_url)
+            if 'json' in ctype:
+                _insert_ajax_fragments(root, json.loads(text))
+            else:
+                # Without JavaScript, Drupal sends us back to the form with the rule already added.
+                root = _parse(text, url)
+
+            # Fill in the date fields and submit.
+            button, form = _find_query_form(root)
+            _set_date_fields(form, start_date.strftime(DATE_FORMAT), end_date.strftime(DATE_FORMAT))
+            data = form.form_values()
+            if button.get('name'):
+                data.append((button.get('name'), button.get('value', '')))
+            url, _, text = await self._gettext(sess, 'POST', form.action or QUERY_URL, data=data)
+
+        return url, get_n_pages(text)
@@ -1,16 +1,31 @@
-import asyncio
 import csv
+import json
+import lxml.html
+import os
+import sys
 
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from bs4 import BeautifulSoup
 
+import metrics
+
+from async_utils import ordered_map
+from http_cache import CacheMissError
+from http_utils import request
+
 GVA_DOMAIN = 'http://www.gunviolencearchive.org'
 
+HEADER = ['date', 'state', 'city_or_county', 'address', 'n_killed', 'n_injured', 'incident_url', 'source_url']
+
+# A request taking longer than this counts as failed and is retried.
+PAGE_TIMEOUT = ClientTimeout(total=60)
+
 def _get_info(tr):
     tds = tr.select('td')
     assert len(tds) == 7
 
-    date, state, city_or_county, address, n_killed, n_injured = [td.contents[0] for td in tds[:6]]
+    # str() so the rows don't hold on to the whole parse tree through their NavigableStrings.
+    date, state, city_or_county, address, n_killed, n_injured = [str(td.contents[0]) if td.contents else '' for td in tds[:6]]
     n_killed, n_injured = map(int, [n_killed, n_injured])
 
     incident_a = tds[6].find('a', string='View Incident')
@@ -21,46 +36,126 @@ def _get_info(tr):
 
     return date, state, city_or_county, address, n_killed, n_injured, incident_url, source_url
 
+def _get_info_lxml(tr):
+    tds = tr.xpath('.//td')
+    assert len(tds) == 7
+
+    date, state, city_or_county, address, n_killed, n_injured = [td.text or '' for td in tds[:6]]
+    n_killed, n_injured = map(int, [n_killed, n_injured])
+
+    incident_a = tds[6].xpath('.//a[. = "View Incident"]')[0]
+    incident_url = GVA_DOMAIN + incident_a.attrib['href']
+
+    source_a = next(iter(tds[6].xpath('.//a[. = "View Source"]')), None)
+    source_url = source_a.attrib['href'] if source_a is not None else ''
+
+    return date, state, city_or_county, address, n_killed, n_injured, incident_url, source_url
+
+def _get_infos(text):
+    soup = BeautifulSoup(text, features='html5lib')
+    trs = soup.select('.responsive tbody tr')
+    return [_get_info(tr) for tr in trs]
+
+def _get_infos_lxml(text):
+    root = lxml.html.document_fromstring(text)
+    # Unlike html5lib, lxml doesn't insert missing <tbody> elements, so match body rows structurally.
+    trs = root.xpath('//*[contains(concat(" ", normalize-space(@class), " "), " responsive ")]'
+                     '//tr[td][not(ancestor::thead or ancestor::tfoot)]')
+    return [_get_info_lxml(tr) for tr in trs]
+
+PARSERS = {
+    'html5lib': _get_infos,
+    'lxml': _get_infos_lxml,
+}
+
+class Stage1PageFetcher(object):
+    # Fetches and parses query result pages, `workers` at a time over one pool of keep-alive connections.
+    # Server errors, dropped connections and timeouts are retried with backoff up to `max_attempts` times.
+    # A page that still fails is logged and handed back as None, so it doesn't take the others down with it.
+    def __init__(self, cache=None, parser='html5lib', workers=20, limiter=None, connector=None, max_attempts=5,
+                 proxy=None):
+        self._cache = cache
+        self._parser = parser
+        self._get_infos = PARSERS[parser]
+        self._workers = workers
+        self._limiter = limiter
+        self._connector = connector
+        self._max_attempts = max_attempts
+        self._proxy = proxy
+
+    async def __aenter__(self):
+        # Share the caller's connector if there is one, e.g. so several months' pages draw from one pool.
+        connector = self._connector or TCPConnector(limit_per_host=self._workers)
+        self._sess = await ClientSession(connector=connector,
+                                         connector_owner=self._connector is None,
+                                         timeout=PAGE_TIMEOUT,
+                                         proxy=self._proxy).__aenter__()
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        await self._sess.__aexit__(type, value, tb)
+
+    async def _gettext(self, url):
+        if self._cache:
+            text = self._cache.get(url)
+            if text is not None:
+                return text
+            if self._cache.offline:
+                raise CacheMissError(url)
+
+        resp = await request(self._sess, 'GET', url, limiter=self._limiter, max_attempts=self._max_attempts)
+        async with resp:
+            resp.raise_for_status()
+            text = await resp.text()
+        if self._cache:
+            self._cache.put(url, text)
+        return text
+
+    async def _read_page(self, page_url):
+        try:
+            text = await self._gettext(page_url)
+            with metrics.timed('parse_seconds', parser=self._parser):
+                infos = self._get_infos(text)
+        except Exception as exc:
+            reason = getattr(exc, 'status', None) or type(exc).__name__
+            print("ERROR! Couldn't read the following page: {} ({})".format(page_url, reason), file=sys.stderr)
+            metrics.inc('pages_failed_total')
+            return None
+        infos.reverse() # Order by ascending date instead of descending
+        return infos
+
+    def read_pages(self, page_urls):
+        # Yields each page's rows, or None if it failed, in the same order as page_urls. Only a bounded window of
+        # fetched pages is held in memory while waiting for earlier ones.
+        return ordered_map(self._read_page, page_urls, workers=self._workers)
+
 class Stage1Serializer(object):
-    def __init__(self, output_fname, encoding='utf-8'):
+    # Pages that couldn't be read are listed in OUTPUT.failed, along with where their rows belong, so that
+    # refetch_failed() can fill them in later without redoing the whole file.
+    def __init__(self, output_fname, encoding='utf-8', cache=None, parser='html5lib', workers=20, limiter=None, connector=None,
+                 proxy=None):
         self._output_fname = output_fname
         self._encoding = encoding
+        self._fetcher = Stage1PageFetcher(cache=cache,
+                                          parser=parser,
+                                          workers=workers,
+                                          limiter=limiter,
+                                          connector=connector,
+                                          proxy=proxy)
         self._page_urls = []
 
     async def __aenter__(self):
         self._output_file = open(self._output_fname, 'w', encoding=self._encoding)
         self._writer = csv.writer(self._output_file)
-        self._sess = await ClientSession().__aenter__()
+        await self._fetcher.__aenter__()
         return self
 
     async def __aexit__(self, type, value, tb):
         self._output_file.__exit__(type, value, tb)
-        await self._sess.__aexit__(type, value, tb)
-
-    async def _gettext(self, url):
-        async with self._sess.get(url) as resp:
-            return await resp.text()
-
-    async def _write_page(self, page_url):
-        text = await self._gettext(page_url)
-        soup = BeautifulSoup(text, features='html5lib')
-        trs = soup.select('.responsive tbody tr')
-        trs = reversed(trs) # Order by ascending date instead of descending
-        infos = map(_get_info, trs)
-        for info in infos:
-            self._writer.writerow([*info])
+        await self._fetcher.__aexit__(type, value, tb)
 
     def write_header(self):
-        self._writer.writerow([
-            'date',
-            'state',
-            'city_or_county',
-            'address',
-            'n_killed',
-            'n_injured',
-            'incident_url',
-            'source_url'
-        ])
+        self._writer.writerow(HEADER)
 
     def write_batch(self, query_url, n_pages):
         batch = ['{}?page={}'.format(query_url, pageno) for pageno in range(n_pages - 1, 0, -1)] + [query_url]
@@ -69,7 +164,77 @@ class Stage1Serializer(object):
     async def flush_writes(self):
         print("Flushing writes made to serializer")
 
-        tasks = (self._write_page(url) for url in self._page_urls)
-        # TODO: This is totally screwing up the order. Who cares though because the perf improvement is amazing.
-        # (If you care about the order, sort the data yourself after loading it in.)
-        return await asyncio.gather(*tasks)
+        # Pages are fetched concurrently but written in the order they were batched, so the output comes out
+        # sorted by date.
+        failed = []
+        n_rows = 0
+        async for page_url, infos in _zip_async(self._page_urls, self._fetcher.read_pages(self._page_urls)):
+            if infos is None:
+                failed.append({'url': page_url, 'row': n_rows})
+                continue
+            for info in infos:
+                self._writer.writerow([*info])
+            n_rows += len(infos)
+            metrics.inc('rows_written_total', len(infos))
+
+        _save_failed(self._output_fname, failed)
+        if failed:
+            print("{} pages of {} couldn't be read. Rerun with --refetch-failed to fill them in".format(
+                len(failed), self._output_fname), file=sys.stderr)
+
+async def _zip_async(items, results):
+    items = iter(items)
+    async for result in results:
+        yield next(items), result
+
+def failed_fname(output_fname):
+    return output_fname + '.failed'
+
+def _load_failed(output_fname):
+    try:
+        with open(failed_fname(output_fname), encoding='utf-8') as failed_file:
+            return [json.loads(line) for line in failed_file]
+    except FileNotFoundError:
+        return []
+
+def _save_failed(output_fname, failed):
+    if not failed:
+        if os.path.exists(failed_fname(output_fname)):
+            os.remove(failed_fname(output_fname))
+        return
+    with open(failed_fname(output_fname), 'w', encoding='utf-8') as failed_file:
+        for page in failed:
+            failed_file.write(json.dumps(page) + '\n')
+
+async def refetch_failed(output_fname, fetcher, encoding='utf-8'):
+    # Fetches the pages listed in OUTPUT.failed again and splices their rows into OUTPUT where they belong.
+    # Pages that fail again stay listed. Returns the number of pages still missing.
+    failed = _load_failed(output_fname)
+    if not failed:
+        return 0
+
+    with open(output_fname, encoding=encoding, newline='') as output_file:
+        header, *rows = list(csv.reader(output_file))
+
+    pages = [page async for page in _zip_async(failed, fetcher.read_pages([page['url'] for page in failed]))]
+    still_failed = []
+    new_rows = []
+    prev = 0
+    for page, infos in pages:
+        new_rows.extend(rows[prev:page['row']])
+        prev = page['row']
+        if infos is None:
+            still_failed.append({'url': page['url'], 'row': len(new_rows)})
+        else:
+            new_rows.extend(infos)
+    new_rows.extend(rows[prev:])
+
+    tmp_fname = output_fname + '.tmp'
+    with open(tmp_fname, 'w', encoding=encoding) as tmp_file:
+        writer = csv.writer(tmp_file)
+        writer.writerow(header)
+        writer.writerows(new_rows)
+    os.replace(tmp_fname, output_fname)
+    _save_failed(output_fname, still_failed)
+    print("{}: filled in {} of {} pages".format(output_fname, len(failed) - len(still_failed), len(failed)), file=sys.stderr)
+    return len(still_failed)
@@ -2,16 +2,24 @@
 # stage 2: augmenting each incident with additional fields, again using scraping
 
 import asyncio
+import itertools
 import logging as log
 import numpy as np
+import os
 import pandas as pd
 import sys
 
 from aiohttp.client_exceptions import ClientResponseError
 from argparse import ArgumentParser
 
+from async_utils import ordered_map
+from http_cache import add_cache_arguments, cache_from_args
 from log_utils import log_first_call
-from stage2_extractor import NIL_FIELDS
+from metrics import add_metrics_arguments, exporter_from_args, inc
+from rate_limiter import limiter_from_args
+from stage2_extractor import ALL_FIELD_NAMES, EXTRACTORS, NIL_FIELDS
+from stage2_journal import Stage2Journal
+from stage2_serializer import Stage2Serializer
 from stage2_session import Stage2Session
 
 SCHEMA = {
@@ -21,6 +29,61 @@ SCHEMA = {
     'n_guns_involved': np.float64,
 }
 
+INCIDENT_URL_PREFIX = 'http://www.gunviolencearchive.org/incident/'
+
+STREAM_CHUNKSIZE = 1000
+STREAM_BATCH_SIZE = 100
+
+def add_session_arguments(parser):
+    parser.add_argument(
+        '-l', '--limit',
+        metavar='NUM',
+        help="limit the number of simultaneous connections aiohttp makes to gunviolencearchive.org",
+        action='store',
+        dest='conn_limit',
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        '--adaptive',
+        help="adjust the number of simultaneous connections to how the server is coping, up to the --limit",
+        action='store_true',
+        dest='adaptive',
+    )
+    parser.add_argument(
+        '-p', '--parser',
+        help="set the HTML parser used to scrape incident pages (default: html5lib)",
+        action='store',
+        dest='parser',
+        choices=sorted(EXTRACTORS),
+        default='html5lib',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='NUM',
+        help="parse incident pages in NUM worker processes so parsing doesn't stall the network. " \
+             "0 parses them on the main thread (default: number of CPUs)",
+        action='store',
+        dest='jobs',
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        '--archive',
+        metavar='DIR',
+        help="also save every incident page in DIR, so reextract.py can rebuild stage2 files without crawling again",
+        action='store',
+        dest='archive_dir',
+    )
+    parser.add_argument(
+        '--proxy',
+        metavar='URL',
+        help="send every request through the HTTP proxy at URL, e.g. mock_server.py",
+        action='store',
+        dest='proxy',
+    )
+    add_cache_arguments(parser)
+
 def parse_args():
     targets_specific_month = False
     if len(sys.argv) > 1:
@@ -45,7 +108,8 @@ def parse_args():
 
     parser.add_argument(
         '-a', '--amend',
-        help="amend existing stage2 file by populating missing values",
+        help="amend existing stage2 file by populating missing values. " \
+             "to repair many files in place, see repair.py",
         action='store_true',
         dest='amend',
     )
@@ -58,22 +122,59 @@ def parse_args():
         default=log.WARNING,
     )
     parser.add_argument(
-        '-l', '--limit',
-        metavar='NUM',
-        help="limit the number of simultaneous connections aiohttp makes to gunviolencearchive.org",
+        '-s', '--stream',
+        help="stream rows from INPUT to OUTPUT as they are fetched instead of holding the whole file in memory",
+        action='store_true',
+        dest='stream',
+    )
+    parser.add_argument(
+        '-r', '--resume',
+        help="resume an interrupted --stream run from its journal (OUTPUT + '.journal'), skipping incidents already written. " \
+             "implies --stream",
+        action='store_true',
+        dest='resume',
+    )
+    parser.add_argument(
+        '--parquet',
+        metavar='DIR',
+        help="also write the output to a Parquet dataset in DIR, partitioned by year and month. requires pyarrow",
         action='store',
-        dest='conn_limit',
-        type=int,
-        default=20,
+        dest='parquet_dir',
+    )
+    parser.add_argument(
+        '--normalized',
+        help="also write participants.OUTPUT and guns.OUTPUT, with one row per participant or gun. requires pyarrow",
+        action='store_true',
+        dest='normalized',
     )
+    add_session_arguments(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    args.cache = cache_from_args(parser, args)
+    args.stream = args.stream or args.resume
+    if args.stream and args.amend:
+        parser.error("--stream and --resume cannot be combined with --amend")
     if targets_specific_month:
         month, year = map(int, parts)
         args.input_fname = 'stage1.{:02d}.{:04d}.csv'.format(month, year)
         args.output_fname = 'stage2.{:02d}.{:04d}.csv'.format(month, year)
+    # Only --stream runs keep a journal. Without one, --resume would quietly start over from the first incident.
+    if args.resume and not os.path.exists(args.output_fname + '.journal'):
+        parser.error("there's nothing to resume: {} doesn't exist. only interrupted --stream runs can be resumed".format(
+            args.output_fname + '.journal'))
     return args
 
+def open_session(args, limiter=None, executor=None):
+    return Stage2Session(cache=args.cache,
+                         parser=args.parser,
+                         jobs=args.jobs,
+                         limiter=limiter or limiter_from_args(args),
+                         executor=executor,
+                         archive_dir=args.archive_dir,
+                         proxy=args.proxy,
+                         limit_per_host=args.conn_limit)
+
 def load_input(args):
     log_first_call()
     return pd.read_csv(args.input_fname,
@@ -81,84 +182,179 @@ def load_input(args):
                        parse_dates=['date'],
                        encoding='utf-8')
 
-def add_incident_id(df):
+def load_input_chunks(args):
     log_first_call()
-    def extract_id(incident_url):
-        PREFIX = 'http://www.gunviolencearchive.org/incident/'
-        assert incident_url.startswith(PREFIX)
-        return int(incident_url[len(PREFIX):])
+    return pd.read_csv(args.input_fname,
+                       dtype=SCHEMA,
+                       parse_dates=['date'],
+                       encoding='utf-8',
+                       chunksize=STREAM_CHUNKSIZE)
+
+def extract_id(incident_url):
+    assert incident_url.startswith(INCIDENT_URL_PREFIX)
+    return int(incident_url[len(INCIDENT_URL_PREFIX):])
 
+def add_incident_id(df):
+    log_first_call()
     df.insert(0, 'incident_id', df['incident_url'].apply(extract_id))
     return df
 
+class FieldColumns(object):
+    # One preallocated column per field, which each incident's fields are written into as they arrive, so
+    # the frame only has to be put together once at the end.
+    def __init__(self, n_rows):
+        self.missing = np.zeros(n_rows, dtype=bool)
+        self.not_found = np.zeros(n_rows, dtype=bool)
+        self.columns = {name: np.full(n_rows, np.nan) if name in SCHEMA else np.full(n_rows, None, dtype=object)
+                        for name in ALL_FIELD_NAMES}
+
+    def set_fields(self, i, fields):
+        for name, value in fields:
+            if value is not None:
+                self.columns[name][i] = value
+
+    def set_missing(self, i, exc):
+        self.missing[i] = True
+        self.not_found[i] = isinstance(exc, ClientResponseError) and exc.status == 404
+
+    def to_frame(self, index):
+        # Gives columns of other numbers, e.g. latitude, a numeric dtype, as assigning a list of them would.
+        return pd.DataFrame({'incident_url_fields_missing': self.missing, **self.columns}, index=index).infer_objects()
+
 async def add_fields_from_incident_url(df, args, predicate=None):
     log_first_call()
-    def field_name(lst):
-        assert len(set([field.name for field in lst])) == 1
-        return lst[0].name
+    def iter_rows():
+        # Rows are made a chunk at a time, so there are never many more of them than requests in flight.
+        for start in range(0, len(subset), STREAM_CHUNKSIZE):
+            yield from subset.iloc[start:start + STREAM_CHUNKSIZE].to_dict('records')
 
-    def field_values(lst):
-        return [field.value for field in lst]
+    async def process(item):
+        i, row = item
+        try:
+            fields = await session.get_fields_from_incident_url(row)
+        except Exception as exc:
+            # Already logged by the session.
+            columns.set_missing(i, exc)
+        else:
+            columns.set_fields(i, fields)
 
     subset = df if predicate is None else df.loc[predicate]
     if len(subset) == 0:
         # No work to do
         return df
 
-    async with Stage2Session(limit_per_host=args.conn_limit) as session:
-        # list of coros of tuples of Fields
-        tasks = subset.apply(session.get_fields_from_incident_url, axis=1)
-        # list of (tuples of Fields) and (exceptions)
-        fields = await asyncio.gather(*tasks, return_exceptions=True)
+    columns = FieldColumns(len(subset))
+    async with open_session(args) as session:
+        async for _ in ordered_map(process, enumerate(iter_rows()), workers=args.conn_limit):
+            pass
+
+    fields = columns.to_frame(subset.index)
+    if predicate is None:
+        return pd.concat([df, fields], axis=1)
 
-    # Temporarily suppress Pandas' SettingWithCopyWarning
-    pd.options.mode.chained_assignment = None
+    df.loc[fields.index, fields.columns] = fields
+    return df.drop(index=subset.index[columns.not_found])
+
+async def fill_row(session, row):
+    # Adds the incident page's fields to a stage1 row, or marks them missing if the page couldn't be scraped.
     try:
-        incident_url_fields_missing = [isinstance(x, Exception) for x in fields]
-        subset['incident_url_fields_missing'] = incident_url_fields_missing
-        
-        not_found = [isinstance(x, ClientResponseError) and x.code == 404 for x in fields]
+        fields = await session.get_fields_from_incident_url(row)
+    except Exception:
+        # Already logged by the session.
+        row['incident_url_fields_missing'] = True
+        fields = NIL_FIELDS
+    else:
+        row['incident_url_fields_missing'] = False
+    row.update(fields)
+    return row
 
-        # list of tuples of Fields
-        fields = [NIL_FIELDS if isinstance(x, Exception) else x for x in fields]
+async def stream_fields_from_incident_url(args, output_fname, limiter=None, executor=None):
+    log_first_call()
+    def iter_rows(chunks, completed_ids):
+        for chunk in chunks:
+            chunk = add_incident_id(chunk)
+            chunk = chunk[~chunk['incident_id'].isin(completed_ids)]
+            yield from chunk.to_dict('records')
 
-        # tuple of lists of Fields, where each list's Fields should have the same name
-        # if the extractor did its job correctly
-        fields = zip(*fields)
-        fields = [(field_name(lst), field_values(lst)) for lst in fields]
+    def on_flush(rows, output_size):
+        journal.record([row['incident_id'] for row in rows], output_size)
 
-        for field_name, field_values in fields:
-            assert subset.shape[0] == len(field_values)
-            subset[field_name] = field_values
+    async def process(row):
+        return await fill_row(session, row)
 
-        subset = subset.astype(SCHEMA)
-    finally:
-        pd.options.mode.chained_assignment = 'warn'
+    chunks = load_input_chunks(args)
+    first_chunk = next(chunks)
+    columns = ['incident_id', *first_chunk.columns, 'incident_url_fields_missing', *ALL_FIELD_NAMES]
+    chunks = itertools.chain([first_chunk], chunks)
 
-    if predicate is not None:
-        df.loc[subset.index] = subset
-        df.drop(index=subset.index[not_found], inplace=True)
+    journal_fname = output_fname + '.journal'
+    if not args.resume and os.path.exists(journal_fname):
+        os.remove(journal_fname)
 
-    return df
+    with Stage2Journal(journal_fname) as journal:
+        completed_ids = journal.completed_ids()
+        resume_at = journal.output_size()
+        if completed_ids:
+            print("Resuming from journal: skipping {} incidents already written".format(len(completed_ids)))
+
+        async with open_session(args, limiter=limiter, executor=executor) as session:
+            with Stage2Serializer(output_fname,
+                                  columns,
+                                  dtype=SCHEMA,
+                                  batch_size=STREAM_BATCH_SIZE,
+                                  resume_at=resume_at,
+                                  on_flush=on_flush) as serializer:
+                # Rows are written in input order, so memory use is bounded by the size of the window
+                # instead of the size of the input.
+                rows = iter_rows(chunks, completed_ids)
+                async for row in ordered_map(process, rows, workers=args.conn_limit):
+                    serializer.write_row(row)
+
+    # The run finished, so there's nothing left to resume.
+    os.remove(journal_fname)
 
 async def main():
     args = parse_args()
     log.basicConfig(level=args.log_level)
 
-    df = load_input(args)
+    async with exporter_from_args(args, 'stage2'):
+        if args.stream:
+            output_fname = args.output_fname
+            await stream_fields_from_incident_url(args, output_fname)
+        else:
+            df = load_input(args)
 
-    if args.amend:
-        output_fname = args.input_fname + args.output_fname
-        df = await add_fields_from_incident_url(df, args, predicate=df['incident_url_fields_missing'])
-    else:
-        output_fname = args.output_fname
-        df = add_incident_id(df)
-        df = await add_fields_from_incident_url(df, args)
-
-    df.to_csv(output_fname,
-              index=False,
-              float_format='%g',
-              encoding='utf-8')
+            if args.amend:
+                output_fname = args.input_fname + args.output_fname
+                df = await add_fields_from_incident_url(df, args, predicate=df['incident_url_fields_missing'])
+            else:
+                output_fname = args.output_fname
+                df = add_incident_id(df)
+                df = await add_fields_from_incident_url(df, args)
+
+            df.to_csv(output_fname,
+                      index=False,
+                      float_format='%g',
+                      encoding='utf-8')
+            inc('rows_written_total', len(df))
+
+    if args.parquet_dir or args.normalized:
+        from columnar import read_csv
+        # Name derived files after the month's stage2 file, so amending it replaces the old data.
+        stage2_fname = args.input_fname if args.amend else output_fname
+        df = read_csv(output_fname)
+
+        if args.parquet_dir:
+            from columnar import write_parquet
+            basename = os.path.splitext(os.path.basename(stage2_fname))[0]
+            write_parquet(df, args.parquet_dir, basename)
+
+        if args.normalized:
+            from normalize import write_normalized
+            dirname, basename = os.path.split(stage2_fname)
+            write_normalized(df,
+                             os.path.join(dirname, 'participants.' + basename),
+                             os.path.join(dirname, 'guns.' + basename))
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
@@ -1,7 +1,9 @@
+import lxml.html
 import re
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
 from collections import defaultdict, namedtuple
+from lxml import etree
 
 from log_utils import log_first_call
 
@@ -37,10 +39,23 @@ ALL_FIELD_NAMES = sorted([
 
 NIL_FIELDS = tuple([Field(name, None) for name in ALL_FIELD_NAMES])
 
-def _find_div_with_title(title, soup):
-    common_parent = soup.select_one('#block-system-main')
-    header = common_parent.find('h2', string=title)
-    return header.parent if header else None
+# Section title on the incident page -> Stage2Extractor method that extracts fields from the section's <div>.
+SECTIONS = {
+    'Location': '_extract_location_fields',
+    'Participants': '_extract_participant_fields',
+    'Incident Characteristics': '_extract_incident_characteristics',
+    'Notes': '_extract_notes',
+    'Guns Involved': '_extract_guns_involved_fields',
+    'Sources': '_extract_sources',
+    'District': '_extract_district_fields',
+}
+
+GEOLOCATION_RE = re.compile(r'^Geolocation:\s+(.*),\s+(.*)$')
+ADDRESS_NUMBER_RE = re.compile(r'^[0-9]+[0-9a-z-]*\b', re.I)
+ADDRESS_SUFFIX_RE = re.compile(r'\b(st|street|rd|road|dr|drive|blvd|boulevard|ave|avenue|hwy|highway)\.?$', re.I)
+N_GUNS_RE = re.compile(r'^([0-9]+)\s+guns?\s+involved.$')
+
+_MAIN_BLOCK = etree.XPath('//*[@id="block-system-main"]')
 
 def _out_name(in_name, prefix=''):
     return prefix + in_name.lower().replace(' ', '_') # e.g. 'Age Group' -> 'participant_age_group'
@@ -78,7 +93,7 @@ def _normalize(fields):
     # Also, add dummy ('field_name', None) fields for missing field names.
     fields = sorted(fields, key=lambda f: f.name)
 
-    field_names = set(next(zip(*fields)))
+    field_names = {field.name for field in fields}
     should_be_empty = field_names - set(ALL_FIELD_NAMES)
     assert not should_be_empty, "We're missing these field names: {}".format(should_be_empty)
 
@@ -109,45 +124,63 @@ def _stringify_dict(d, insep='::', outsep='||'):
     return outsep.join([insep.join([k, v]) for k, v in zip(keys, values)])
 
 class Stage2Extractor(object):
+    # Parses pages with html5lib via BeautifulSoup. Subclasses can swap in a different parser by overriding
+    # the DOM access methods (_parse through _lines_before_brs); the _extract_* methods only go through those.
     def extract_fields(self, text, ctx):
         log_first_call()
-        soup = BeautifulSoup(text, features='html5lib')
-
-        location_fields = self._extract_location_fields(soup, ctx)
-        participant_fields = self._extract_participant_fields(soup)
-        incident_characteristics = self._extract_incident_characteristics(soup)
-        notes = self._extract_notes(soup)
-        guns_involved_fields = self._extract_guns_involved_fields(soup)
-        sources = self._extract_sources(soup)
-        district_fields = self._extract_district_fields(soup)
-
-        return _normalize([*location_fields,
-                           *participant_fields,
-                            Field('incident_characteristics', incident_characteristics),
-                            Field('notes', notes),
-                           *guns_involved_fields,
-                            Field('sources', sources),
-                           *district_fields])
-
-    def _extract_location_fields(self, soup, ctx):
+        root = self._parse(text)
+
+        fields = []
+        for title, method in SECTIONS.items():
+            div = self._find_div_with_title(title, root)
+            if div is not None:
+                fields.extend(getattr(self, method)(div, ctx))
+        return _normalize(fields)
+
+    def _parse(self, text):
+        return BeautifulSoup(text, features='html5lib')
+
+    def _find_div_with_title(self, title, root):
+        common_parent = root.select_one('#block-system-main')
+        header = common_parent.find('h2', string=title)
+        return header.parent if header else None
+
+    def _select(self, element, tag):
+        return element.select(tag)
+
+    def _select_one(self, element, tag):
+        return element.select_one(tag)
+
+    def _text(self, element):
+        return element.text
+
+    def _href(self, a):
+        return a['href']
+
+    def _lines_before_brs(self, div):
+        # The text we want to scrape is orphaned (no direct parent element), so we can't get at it directly.
+        # Fortunately, each important line is followed by a <br> element, so we can use that to our advantage.
+        # NB: The orphaned text elements are of type 'NavigableString'. A <br> that follows another element, a
+        # comment or nothing at all has no line before it, the same as what lxml's .tail gives.
+        lines = []
+        for br in div.select('br'):
+            prev = br.previousSibling
+            lines.append(prev.strip() if type(prev) is NavigableString else '')
+        return lines
+
+    def _extract_location_fields(self, div, ctx):
         def describes_city_and_state(line):
             return ',' in line and line.endswith(ctx.state) # and line.startswith(ctx.city_or_county)
 
         def describes_address(line):
             # The address on the incident page usually, but not always, matches the address on the query page.
-            return line == ctx.address or \
-                re.search(r'^[0-9]+[0-9a-z-]*\b', line, re.I) or \
-                re.search(r'\b(st|street|rd|road|dr|drive|blvd|boulevard|ave|avenue|hwy|highway)\.?$', line, re.I)
+            return line == ctx.address or ADDRESS_NUMBER_RE.search(line) or ADDRESS_SUFFIX_RE.search(line)
 
-        div = _find_div_with_title('Location', soup)
-        if div is None:
-            return
-
-        for span in div.select('span'):
-            text = span.text
+        for span in self._select(div, 'span'):
+            text = self._text(span)
             if not text:
                 continue
-            match = re.search(r'^Geolocation:\s+(.*),\s+(.*)$', text)
+            match = GEOLOCATION_RE.search(text)
             if match:
                 latitude, longitude = float(match.group(1)), float(match.group(2))
                 yield Field('latitude', latitude)
@@ -158,60 +191,101 @@ class Stage2Extractor(object):
             else:
                 yield Field('location_description', text)
 
-    def _extract_participant_fields(self, soup):
-        div = _find_div_with_title('Participants', soup)
-        if div is None:
-            return
+    def _linegroups(self, div):
+        return [[self._text(li) for li in self._select(ul, 'li')] for ul in self._select(div, 'ul')]
 
-        linegroups = [[li.text for li in ul.select('li')] for ul in div.select('ul')]
+    def _extract_participant_fields(self, div, ctx):
+        linegroups = self._linegroups(div)
         for field_name, field_values in _getdicts(linegroups).items():
             field_name = _out_name(field_name, prefix='participant_')
             field_values = _stringify_dict(field_values)
             yield Field(field_name, field_values)
 
-    def _extract_incident_characteristics(self, soup):
-        div = _find_div_with_title('Incident Characteristics', soup)
-        return None if div is None else _stringify_list([li.text for li in div.select('li')])
-
-    def _extract_notes(self, soup):
-        div = _find_div_with_title('Notes', soup)
-        return None if div is None else div.select_one('p').text
+    def _extract_incident_characteristics(self, div, ctx):
+        yield Field('incident_characteristics', _stringify_list([self._text(li) for li in self._select(div, 'li')]))
 
-    def _extract_guns_involved_fields(self, soup):
-        div = _find_div_with_title('Guns Involved', soup)
-        if div is None:
-            return
+    def _extract_notes(self, div, ctx):
+        yield Field('notes', self._text(self._select_one(div, 'p')))
 
+    def _extract_guns_involved_fields(self, div, ctx):
         # n_guns_involved
-        p_text = div.select_one('p').text
-        match = re.search(r'^([0-9]+)\s+guns?\s+involved.$', p_text)
+        p_text = self._text(self._select_one(div, 'p'))
+        match = N_GUNS_RE.search(p_text)
         assert match, "<p> text did not match expected pattern: {}".format(p_text)
         n_guns_involved = int(match.group(1))
         yield Field('n_guns_involved', n_guns_involved)
 
         # List attributes
-        linegroups = [[li.text for li in ul.select('li')] for ul in div.select('ul')]
+        linegroups = self._linegroups(div)
         for field_name, field_values in _getdicts(linegroups).items():
             field_name = _out_name(field_name, prefix='gun_')
             field_values = _stringify_dict(field_values)
             yield Field(field_name, field_values)
 
-    def _extract_sources(self, soup):
-        div = _find_div_with_title('Sources', soup)
-        if div is None:
-            return None
-
-        anchors = [a for a in div.select('a') if a.text == a['href']]
-        return _stringify_list([a['href'] for a in anchors])
+    def _extract_sources(self, div, ctx):
+        anchors = [a for a in self._select(div, 'a') if self._text(a) == self._href(a)]
+        yield Field('sources', _stringify_list([self._href(a) for a in anchors]))
 
-    def _extract_district_fields(self, soup):
-        div = _find_div_with_title('District', soup)
-        if div is None:
-            return
-
-        # The text we want to scrape is orphaned (no direct parent element), so we can't get at it directly.
-        # Fortunately, each important line is followed by a <br> element, so we can use that to our advantage.
-        # NB: The orphaned text elements are of type 'NavigableString'
-        lines = [str(br.previousSibling).strip() for br in div.select('br')]
+    def _extract_district_fields(self, div, ctx):
+        lines = self._lines_before_brs(div)
         for key, value in _getdict(lines, apply=int).items():
             yield Field(_out_name(key), value)
+
+class LxmlStage2Extractor(Stage2Extractor):
+    # Same extraction logic as Stage2Extractor, but parses pages with lxml, which is much faster than html5lib.
+    def _parse(self, text):
+        return lxml.html.document_fromstring(text)
+
+    def _find_div_with_title(self, title, root):
+        common_parent = root.get_element_by_id('block-system-main')
+        header = next(iter(common_parent.xpath('.//h2[. = $title]', title=title)), None)
+        return header.getparent() if header is not None else None
+
+    def _select(self, element, tag):
+        return list(element.iterdescendants(tag))
+
+    def _select_one(self, element, tag):
+        return next(element.iterdescendants(tag), None)
+
+    def _text(self, element):
+        return element.text_content()
+
+    def _href(self, a):
+        return a.attrib['href']
+
+    def _lines_before_brs(self, div):
+        lines = []
+        for br in div.iterdescendants('br'):
+            prev = br.getprevious()
+            text = br.getparent().text if prev is None else prev.tail
+            lines.append((text or '').strip())
+        return lines
+
+class CompiledStage2Extractor(LxmlStage2Extractor):
+    # Walks the main block once, handing each <h2> section to its _extract_* method through SECTIONS, instead
+    # of searching the page once per section. Pages are parsed into plain lxml elements, which are cheaper to
+    # build and traverse than lxml.html's.
+    _parser = etree.HTMLParser()
+
+    def extract_fields(self, text, ctx):
+        log_first_call()
+        common_parent = _MAIN_BLOCK(etree.fromstring(text, self._parser))[0]
+
+        fields = []
+        done = set()
+        for header in common_parent.iter('h2'):
+            method = SECTIONS.get(self._text(header))
+            # Only the first section with a given title counts, as with _find_div_with_title.
+            if method is not None and method not in done:
+                done.add(method)
+                fields.extend(getattr(self, method)(header.getparent(), ctx))
+        return _normalize(fields)
+
+    def _text(self, element):
+        return ''.join(element.itertext())
+
+EXTRACTORS = {
+    'html5lib': Stage2Extractor,
+    'lxml': LxmlStage2Extractor,
+    'compiled': CompiledStage2Extractor,
+}
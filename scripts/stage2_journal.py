@@ -0,0 +1,29 @@
+import sqlite3
+
+class Stage2Journal(object):
+    def __init__(self, fname):
+        self._fname = fname
+
+    def __enter__(self):
+        self._conn = sqlite3.connect(self._fname)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS completed (incident_id INTEGER PRIMARY KEY)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY CHECK (id = 0), output_size INTEGER)')
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._conn.close()
+
+    def completed_ids(self):
+        return set(incident_id for incident_id, in self._conn.execute('SELECT incident_id FROM completed'))
+
+    def output_size(self):
+        row = self._conn.execute('SELECT output_size FROM checkpoint').fetchone()
+        return row[0] if row else None
+
+    def record(self, incident_ids, output_size):
+        # The output file must already have been synced to disk. If we crash before this commits,
+        # the next run truncates the output back to the previous checkpoint and refetches these incidents.
+        with self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO completed VALUES (?)', [(int(id),) for id in incident_ids])
+            self._conn.execute('INSERT OR REPLACE INTO checkpoint VALUES (0, ?)', (output_size,))
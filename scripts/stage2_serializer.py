@@ -0,0 +1,55 @@
+import os
+import pandas as pd
+
+import metrics
+
+class Stage2Serializer(object):
+    def __init__(self, output_fname, columns, dtype=None, batch_size=500, encoding='utf-8', resume_at=None, on_flush=None):
+        self._output_fname = output_fname
+        self._columns = columns
+        self._dtype = dtype
+        self._batch_size = batch_size
+        self._encoding = encoding
+        self._resume_at = resume_at
+        self._on_flush = on_flush
+        self._rows = []
+
+    def __enter__(self):
+        if self._resume_at is None:
+            self._output_file = open(self._output_fname, 'w', encoding=self._encoding, newline='')
+            pd.DataFrame(columns=self._columns).to_csv(self._output_file, index=False)
+        else:
+            # Discard anything written after the last checkpoint, then append to what's left.
+            self._output_file = open(self._output_fname, 'r+', encoding=self._encoding, newline='')
+            self._output_file.truncate(self._resume_at)
+            self._output_file.seek(0, os.SEEK_END)
+        return self
+
+    def __exit__(self, type, value, tb):
+        try:
+            self.flush()
+        finally:
+            self._output_file.__exit__(type, value, tb)
+
+    def write_row(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+
+        df = pd.DataFrame.from_records(self._rows, columns=self._columns)
+        if self._dtype:
+            df = df.astype(self._dtype)
+        df.to_csv(self._output_file,
+                  header=False,
+                  index=False,
+                  float_format='%g')
+        self._output_file.flush()
+        metrics.inc('rows_written_total', len(self._rows))
+        if self._on_flush:
+            os.fsync(self._output_file.fileno())
+            self._on_flush(self._rows, os.fstat(self._output_file.fileno()).st_size)
+        self._rows.clear()
@@ -1,92 +1,154 @@
 import asyncio
-import math
-import numpy as np
-import platform
 import sys
+import time
 import traceback as tb
 
-from aiohttp import ClientResponse, ClientSession, TCPConnector
-from aiohttp.client_exceptions import ClientOSError, ClientResponseError
-from aiohttp.hdrs import CONTENT_TYPE
-from asyncio import CancelledError
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.client_exceptions import ClientResponseError
+from aiohttp.hdrs import CONTENT_TYPE, ETAG, IF_MODIFIED_SINCE, IF_NONE_MATCH, LAST_MODIFIED
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
+import metrics
+
+from http_cache import CacheMissError
+from http_utils import request
 from log_utils import log_first_call
-from stage2_extractor import Stage2Extractor
+from page_archive import PageArchiveWriter
+from stage2_extractor import EXTRACTORS
 
 Context = namedtuple('Context', ['address', 'city_or_county', 'state'])
 
-def _compute_wait(average_wait, rng_base):
-    log_first_call()
-    log_average_wait = math.log(average_wait, rng_base)
-    fuzz = np.random.standard_normal(size=1)[0]
-    return int(np.ceil(rng_base ** (log_average_wait + fuzz)))
+# The extractor used by each ProcessPoolExecutor worker. It's created once per process by _init_worker().
+_worker_extractor = None
+
+def _init_worker(parser):
+    global _worker_extractor
+    _worker_extractor = EXTRACTORS[parser]()
 
-def _status_from_exception(exc):
-    if isinstance(exc, CancelledError):
-        return '<canceled>'
-    if isinstance(exc, ClientOSError) and platform.system() == 'Windows' and exc.errno == 10054:
-        # WinError: An existing connection was forcibly closed by the remote host
-        return '<conn closed>'
-    if isinstance(exc, asyncio.TimeoutError):
-        return '<timed out>'
+def extraction_executor(parser, jobs):
+    # A pool of `jobs` processes that parse pages with the given extractor. Pass it to several Stage2Sessions
+    # to share it between them.
+    return ProcessPoolExecutor(max_workers=jobs,
+                               initializer=_init_worker,
+                               initargs=(parser,))
 
-    return ''
+def _extract_fields(text, ctx):
+    # Timed here rather than by the caller, so the time spent waiting for a free worker isn't counted.
+    start = time.perf_counter()
+    fields = _worker_extractor.extract_fields(text, ctx)
+    return fields, time.perf_counter() - start
 
 class Stage2Session(object):
-    def __init__(self, **kwargs):
-        self._extractor = Stage2Extractor()
+    def __init__(self, cache=None, parser='html5lib', jobs=0, limiter=None, executor=None, archive_dir=None, proxy=None,
+                 **kwargs):
+        # If jobs > 0, pages are parsed by that many worker processes instead of on the event loop, unless
+        # an extraction_executor() for the same parser is given to use instead.
+        # If limiter is given, it decides how many requests may be in flight at once.
+        # If archive_dir is given, every page that's extracted is also saved there, for reextract.py.
+        # If proxy is given, every request goes through it, e.g. to crawl mock_server.py instead.
+        self._extractor = EXTRACTORS[parser]()
+        self._parser = parser
+        self._jobs = jobs
+        self._shared_executor = executor
+        self._cache = cache
+        self._limiter = limiter
+        self._archive_dir = archive_dir
+        self._proxy = proxy
         self._conn_options = kwargs
 
     async def __aenter__(self):
+        self._executor = self._shared_executor
+        if self._executor is None and self._jobs > 0:
+            self._executor = extraction_executor(self._parser, self._jobs)
+        self._archive = None
+        if self._archive_dir:
+            self._archive = PageArchiveWriter(self._archive_dir).__enter__()
         conn = TCPConnector(**self._conn_options)
-        self._sess = await ClientSession(connector=conn).__aenter__()
+        self._sess = await ClientSession(connector=conn, proxy=self._proxy).__aenter__()
         return self
 
     async def __aexit__(self, type, value, tb):
-        await self._sess.__aexit__(type, value, tb)
-
-    def _log_retry(self, url, status, retry_wait):
-        print("GET request to {} failed with status {}. Trying again in {}s...".format(url, status, retry_wait), file=sys.stderr)
+        try:
+            await self._sess.__aexit__(type, value, tb)
+        finally:
+            if self._executor and self._executor is not self._shared_executor:
+                self._executor.shutdown(cancel_futures=True)
+            if self._archive:
+                self._archive.__exit__(type, value, tb)
 
     def _log_extraction_failed(self, url):
         print("ERROR! Extraction failed for the following url: {}".format(url), file=sys.stderr)
 
-    async def _get(self, url, average_wait=10, rng_base=2):
-        while True:
-            try:
-                resp = await self._sess.get(url)
-            except Exception as exc:
-                status = _status_from_exception(exc)
-                if not status:
-                    raise
-            else:
-                status = resp.status
-                if status < 500: # Suceeded or client error
-                    return resp
-                # It's a server error. Dispose the response and retry.
-                await resp.release()
+    async def _get(self, url):
+        return await request(self._sess, 'GET', url, limiter=self._limiter)
 
-            wait = _compute_wait(average_wait, rng_base)
-            self._log_retry(url, status, wait)
-            await asyncio.sleep(wait)
+    async def _gettext(self, url):
+        if self._cache:
+            text = self._cache.get(url)
+            if text is not None:
+                return text
+            if self._cache.offline:
+                raise CacheMissError(url)
 
-    async def _get_fields_from_incident_url(self, row):
-        incident_url = row['incident_url']
-        resp = await self._get(incident_url)
+        resp = await self._get(url)
         async with resp:
             resp.raise_for_status()
-            ctype = resp.headers.get(CONTENT_TYPE, '').lower()
-            mimetype = ctype[:ctype.find(';')]
-            if mimetype in ('text/htm', 'text/html'):
-                text = await resp.text()
-            else:
-                raise NotImplementedError("Encountered unknown mime type {}".format(mimetype))
+            text = await self._read_html(resp)
+
+        if self._cache:
+            self._cache.put(url, text)
+        return text
+
+    async def _read_html(self, resp):
+        ctype = resp.headers.get(CONTENT_TYPE, '').lower()
+        mimetype = ctype[:ctype.find(';')]
+        if mimetype in ('text/htm', 'text/html'):
+            return await resp.text()
+        raise NotImplementedError("Encountered unknown mime type {}".format(mimetype))
+
+    async def get_if_modified(self, url, etag=None, last_modified=None):
+        # Conditional GET that bypasses the cache lookup. Returns None if the server says the page hasn't
+        # changed since it sent `etag`/`last_modified`, otherwise (text, etag, last_modified) for the new copy.
+        headers = {}
+        if etag:
+            headers[IF_NONE_MATCH] = etag
+        if last_modified:
+            headers[IF_MODIFIED_SINCE] = last_modified
+
+        resp = await request(self._sess, 'GET', url, limiter=self._limiter, headers=headers)
+        async with resp:
+            if resp.status == 304:
+                return None
+            resp.raise_for_status()
+            text = await self._read_html(resp)
 
+        if self._cache:
+            self._cache.put(url, text)
+        return text, resp.headers.get(ETAG), resp.headers.get(LAST_MODIFIED)
+
+    async def extract_fields(self, row, text):
+        if self._archive:
+            # Compressing and writing the page would otherwise hold up the event loop.
+            await asyncio.get_event_loop().run_in_executor(None, self._archive.put, int(row['incident_id']), text)
         ctx = Context(address=row['address'],
                       city_or_county=row['city_or_county'],
                       state=row['state'])
-        return self._extractor.extract_fields(text, ctx)
+        return await self._extract_fields(text, ctx)
+
+    async def _get_fields_from_incident_url(self, row):
+        text = await self._gettext(row['incident_url'])
+        return await self.extract_fields(row, text)
+
+    async def _extract_fields(self, text, ctx):
+        if self._executor is None:
+            with metrics.timed('parse_seconds', parser=self._parser):
+                return self._extractor.extract_fields(text, ctx)
+
+        loop = asyncio.get_event_loop()
+        fields, elapsed = await loop.run_in_executor(self._executor, _extract_fields, text, ctx)
+        metrics.observe('parse_seconds', elapsed, parser=self._parser)
+        return fields
 
     async def get_fields_from_incident_url(self, row):
         log_first_call()
@@ -98,6 +160,8 @@ class Stage2Session(object):
             if isinstance(exc, ClientResponseError) and exc.code == 404:
                 # 404 is handled gracefully by us so this isn't too newsworthy.
                 pass
+            elif isinstance(exc, CacheMissError):
+                print("Skipping {} because it isn't cached".format(exc.url), file=sys.stderr)
             else:
                 self._log_extraction_failed(row['incident_url'])
                 tb.print_exc()
@@ -1,48 +1,295 @@
 #!/usr/bin/env python3
 # stage 3: sorting and merging data
 
-import numpy as np
-import pandas as pd
+import csv
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
 
+from argparse import ArgumentParser
 from glob import glob
+from operator import itemgetter
 
 STAGE2_GLOB = 'stage2.*.csv'
+OUTPUT_FNAME = 'stage3.csv'
+MANIFEST_FNAME = 'stage3.manifest.json'
 
-SCHEMA = {
-    'congressional_district': np.float64,
-    'state_house_district': np.float64,
-    'state_senate_district': np.float64,
-    'n_guns_involved': np.float64,
-}
-
-def load_csv(csv_fname):
-    return pd.read_csv(csv_fname,
-                       dtype=SCHEMA,
-                       parse_dates=['date'],
-                       encoding='utf-8')
-
-def inner_sort(dfs):
-    for df in dfs:
-        assert all(~df['date'].isna())
-        df.sort_values('date', inplace=True)
-
-def outer_sort(dfs):
-    # If the first incident in one file took place earlier than the first incident in another,
-    # we assume all incidents in the former took place earlier than all incidents in the latter.
-    dfs.sort(key=lambda df: df.loc[0].date)
+# Stage 2 writes dates as YYYY-MM-DD, so they sort correctly as strings.
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--parquet',
+        metavar='DIR',
+        help="also write the output to a Parquet dataset in DIR, partitioned by year and month. requires pyarrow",
+        action='store',
+        dest='parquet_dir',
+    )
+    parser.add_argument(
+        '--normalized',
+        help="also write participants.csv and guns.csv, with one row per participant or gun. " \
+             "implies --full. requires pyarrow",
+        action='store_true',
+        dest='normalized',
+    )
+    parser.add_argument(
+        '-f', '--full',
+        help="rebuild stage3.csv from scratch instead of reprocessing only the stage2 files that changed",
+        action='store_true',
+        dest='full',
+    )
+    return parser.parse_args()
+
+def read_header(csv_fname):
+    with open(csv_fname, encoding='utf-8', newline='') as csv_file:
+        return next(csv.reader(csv_file))
+
+def iter_rows(csv_fname):
+    with open(csv_fname, encoding='utf-8', newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader)
+        yield from reader
+
+def is_sorted(csv_fname, date_index):
+    prev_date = ''
+    for row in iter_rows(csv_fname):
+        date = row[date_index]
+        assert DATE_PATTERN.match(date), "{} has a malformed date: {!r}".format(csv_fname, date)
+        if date < prev_date:
+            return False
+        prev_date = date
+    return True
+
+def iter_tmp_rows(tmp_file):
+    with tmp_file:
+        yield from csv.reader(tmp_file)
+
+def sorted_rows(csv_fname, date_index):
+    # Files written by the current stage1/stage2 are already in date order and can be streamed as-is.
+    # Older ones are sorted in memory and spilled to a temporary file before the next one is read, so
+    # merging many of them only ever holds one file in memory.
+    if is_sorted(csv_fname, date_index):
+        return iter_rows(csv_fname)
+    rows = sorted(iter_rows(csv_fname), key=itemgetter(date_index))
+    tmp_file = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+    csv.writer(tmp_file).writerows(rows)
+    tmp_file.seek(0)
+    return iter_tmp_rows(tmp_file)
+
+def segment_months(segment):
+    if not segment['rows']:
+        return
+    year, month = int(segment['first_date'][:4]), int(segment['first_date'][5:7])
+    while '{:04d}-{:02d}'.format(year, month) <= segment['last_date'][:7]:
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+def parquet_sink(parquet_dir):
+    from columnar import write_parquet
+    def sink(df):
+        write_parquet(df, parquet_dir, 'stage3')
+    return sink
+
+def normalized_sink(participants_fname, guns_fname):
+    from normalize import write_normalized
+    header = True
+    def sink(df):
+        nonlocal header
+        write_normalized(df, participants_fname, guns_fname, header=header)
+        header = False
+    return sink
+
+def tee_by_month(rows, header, date_index, sinks):
+    from columnar import read_csv
+    # Rows arrive in date order, so each month is contiguous and only one month is buffered at a time.
+    for _, month_rows in itertools.groupby(rows, key=lambda row: row[date_index][:7]):
+        month_rows = list(month_rows)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        writer.writerows(month_rows)
+        buffer.seek(0)
+        df = read_csv(buffer)
+        for sink in sinks:
+            sink(df)
+        yield from month_rows
+
+def describe(csv_fname, date_index, cached=None):
+    stat = os.stat(csv_fname)
+    if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(csv_fname, 'rb') as csv_file:
+        for block in iter(lambda: csv_file.read(1 << 20), b''):
+            digest.update(block)
+    dates = [row[date_index] for row in iter_rows(csv_fname)]
+    return {
+        'fname': csv_fname,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha256': digest.hexdigest(),
+        'first_date': min(dates, default=''),
+        'last_date': max(dates, default=''),
+        'rows': len(dates),
+    }
+
+def months_overlap(segments):
+    # The output can only be spliced if each file's rows form one contiguous block, and a
+    # month is never split between files (Parquet partitions are replaced a month at a time).
+    nonempty = [segment for segment in segments if segment['rows']]
+    return any(b['first_date'][:7] <= a['last_date'][:7] for a, b in zip(nonempty, nonempty[1:]))
+
+def load_manifest(header):
+    try:
+        with open(MANIFEST_FNAME, encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+    # If stage3.csv was touched by anything else since, the recorded offsets can't be trusted.
+    if manifest['header'] != header or not os.path.exists(OUTPUT_FNAME) or \
+       os.path.getsize(OUTPUT_FNAME) != manifest['output_size']:
+        return None
+    return manifest
+
+def save_manifest(header, segments, parquet_dir):
+    manifest = {
+        'header': header,
+        'output_size': os.path.getsize(OUTPUT_FNAME),
+        'parquet_dir': parquet_dir,
+        'segments': segments,
+    }
+    tmp_fname = MANIFEST_FNAME + '.tmp'
+    with open(tmp_fname, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(tmp_fname, MANIFEST_FNAME)
+
+def remove_manifest():
+    try:
+        os.remove(MANIFEST_FNAME)
+    except FileNotFoundError:
+        pass
+
+def merge_all(csv_fnames, header, date_index, sinks):
+    # Merge the files by ascending date, reading each one as a stream so memory use doesn't grow
+    # with the size of the dataset. Unlike sorting whole files by their first date, this also
+    # handles files whose date ranges overlap.
+    streams = [sorted_rows(csv_fname, date_index) for csv_fname in csv_fnames]
+    rows = heapq.merge(*streams, key=itemgetter(date_index))
+    if sinks:
+        rows = tee_by_month(rows, header, date_index, sinks)
+
+    with open(OUTPUT_FNAME, 'w', encoding='utf-8', newline='') as output_file:
+        writer = csv.writer(output_file, lineterminator=os.linesep)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def splice(segments, old_segments, header, date_index, sinks):
+    # stage3.csv is the files' rows laid end to end. Keep the longest prefix of files that haven't
+    # changed, then rebuild the rest: unchanged files are copied from their old byte range and only
+    # new or changed files are re-read. Adding the next month only appends to the end.
+    keep = 0
+    while keep < min(len(segments), len(old_segments)) and \
+          segments[keep]['fname'] == old_segments[keep]['fname'] and \
+          segments[keep]['sha256'] == old_segments[keep]['sha256']:
+        segments[keep] = old_segments[keep]
+        keep += 1
+
+    if not old_segments:
+        with open(OUTPUT_FNAME, 'w', encoding='utf-8', newline='') as output_file:
+            csv.writer(output_file, lineterminator=os.linesep).writerow(header)
+    if keep:
+        offset = segments[keep - 1]['offset'] + segments[keep - 1]['length']
+        row_start = segments[keep - 1]['row_start'] + segments[keep - 1]['rows']
+    else:
+        offset = os.path.getsize(OUTPUT_FNAME) if not old_segments else old_segments[0]['offset']
+        row_start = 0
+    if keep == len(segments) and keep == len(old_segments):
+        return
+
+    print("Reusing {} of {} files, rewriting stage3.csv from byte {}".format(keep, len(segments), offset),
+          file=sys.stderr)
+    reusable = {(segment['fname'], segment['sha256']): segment for segment in old_segments[keep:]}
+    tmp_fname = OUTPUT_FNAME + '.tmp'
+    with open(OUTPUT_FNAME, 'rb') as old_file, \
+         open(tmp_fname, 'w', encoding='utf-8', newline='') as tmp_file:
+        writer = csv.writer(tmp_file, lineterminator=os.linesep)
+        for segment in segments[keep:]:
+            start = tmp_file.tell()
+            old_segment = reusable.get((segment['fname'], segment['sha256']))
+            if old_segment:
+                old_file.seek(old_segment['offset'])
+                tmp_file.buffer.write(old_file.read(old_segment['length']))
+            else:
+                rows = sorted_rows(segment['fname'], date_index)
+                if sinks:
+                    rows = tee_by_month(rows, header, date_index, sinks)
+                writer.writerows(rows)
+            tmp_file.flush()
+            segment['offset'] = offset + start
+            segment['length'] = tmp_file.tell() - start
+            segment['row_start'] = row_start
+            row_start += segment['rows']
+
+    with open(OUTPUT_FNAME, 'r+b') as output_file, open(tmp_fname, 'rb') as tmp_file:
+        output_file.truncate(offset)
+        output_file.seek(offset)
+        shutil.copyfileobj(tmp_file, output_file)
+    os.remove(tmp_fname)
+
+def build(parquet_dir=None, normalized=False, full=False):
+    csv_fnames = sorted(glob(STAGE2_GLOB))
+    header = read_header(csv_fnames[0])
+    for csv_fname in csv_fnames:
+        assert read_header(csv_fname) == header, "{} has different columns than {}".format(csv_fname, csv_fnames[0])
+    date_index = header.index('date')
+
+    sinks = []
+    if parquet_dir:
+        sinks.append(parquet_sink(parquet_dir))
+    if normalized:
+        sinks.append(normalized_sink('participants.csv', 'guns.csv'))
+
+    manifest = None if full or normalized else load_manifest(header)
+    # Only the changed files' months reach the sink on a partial rebuild, so the Parquet dataset has to be
+    # the one the last run kept up to date. Otherwise it's written from scratch.
+    if parquet_dir:
+        parquet_dir = os.path.abspath(parquet_dir)
+        if manifest and (manifest.get('parquet_dir') != parquet_dir or not os.path.isdir(parquet_dir)):
+            manifest = None
+    old_segments = manifest['segments'] if manifest else []
+    cached = {segment['fname']: segment for segment in old_segments}
+    segments = [describe(csv_fname, date_index, cached.get(csv_fname)) for csv_fname in csv_fnames]
+    segments.sort(key=itemgetter('first_date', 'fname'))
+
+    # Start from an unknown state: if we're interrupted, the next run does a full rebuild.
+    remove_manifest()
+    overlap = months_overlap(segments)
+    if parquet_dir:
+        from columnar import remove_parquet
+        # Drop the months of files that were deleted or are about to be re-read, or everything if the whole
+        # output is rewritten.
+        current = {(segment['fname'], segment['sha256']) for segment in segments}
+        stale = [segment for segment in old_segments if (segment['fname'], segment['sha256']) not in current]
+        months = None if overlap or not manifest else {month for segment in stale for month in segment_months(segment)}
+        remove_parquet(parquet_dir, 'stage3', months)
+    if overlap:
+        merge_all(csv_fnames, header, date_index, sinks)
+    else:
+        splice(segments, old_segments, header, date_index, sinks)
+        save_manifest(header, segments, parquet_dir)
 
 def main():
-    # Sort the dataframes by ascending date, then sort by ascending date *within* each dataframe,
-    # then merge into 1 giant CSV.
-    dfs = [load_csv(fname) for fname in glob(STAGE2_GLOB)]
-    inner_sort(dfs)
-    outer_sort(dfs)
-
-    giant_df = pd.concat(dfs, ignore_index=True)
-    giant_df.to_csv('stage3.csv',
-                    index=False,
-                    float_format='%g',
-                    encoding='utf-8')
+    args = parse_args()
+    build(parquet_dir=args.parquet_dir, normalized=args.normalized, full=args.full)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import time
+
+PENDING, LEASED, DONE = 0, 1, 2
+
+class WorkQueue(object):
+    # A queue of stage2 rows to fetch, shared by the workers of a coordinator.py run. Tasks are leased rather
+    # than handed out, so a task whose worker dies without completing it goes back to the queue when its lease
+    # expires. Everything lives in one SQLite file, so the coordinator can be restarted without losing work.
+    def __init__(self, fname, max_attempts=5):
+        self._fname = fname
+        self._max_attempts = max_attempts
+
+    def __enter__(self):
+        self._conn = sqlite3.connect(self._fname)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS months (month TEXT PRIMARY KEY, output_fname TEXT, columns TEXT, written INTEGER)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, month TEXT, seq INTEGER, row TEXT, '
+                               'state INTEGER, worker TEXT, lease_expires REAL, attempts INTEGER, result TEXT)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, lease_expires)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS tasks_by_month ON tasks (month, seq)')
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._conn.close()
+
+    def has_month(self, month):
+        return self._conn.execute('SELECT 1 FROM months WHERE month = ?', (month,)).fetchone() is not None
+
+    def add_month(self, month, output_fname, columns, rows):
+        # rows are dicts, in the order they should be written out.
+        with self._conn:
+            self._conn.execute('INSERT INTO months VALUES (?, ?, ?, 0)', (month, output_fname, json.dumps(columns)))
+            self._conn.executemany('INSERT INTO tasks VALUES (NULL, ?, ?, ?, ?, NULL, NULL, 0, NULL)',
+                                   [(month, seq, json.dumps(row), PENDING) for seq, row in enumerate(rows)])
+
+    def lease(self, worker, n, lease_seconds):
+        # Hands out up to n tasks that are pending or whose lease has expired, as a list of (task_id, row).
+        now = time.time()
+        with self._conn:
+            tasks = self._conn.execute('SELECT id, row, attempts FROM tasks '
+                                       'WHERE state = ? OR (state = ? AND lease_expires < ?) '
+                                       'ORDER BY month, seq LIMIT ?', (PENDING, LEASED, now, n)).fetchall()
+            # A task that keeps getting leased and never completed probably kills its workers, so stop handing
+            # it out. It's written out with its fields missing, for repair.py to retry later.
+            dead = [(task_id, row) for task_id, row, attempts in tasks if attempts >= self._max_attempts]
+            for task_id, row in dead:
+                self._complete(task_id, dict(json.loads(row), incident_url_fields_missing=True))
+
+            live = [(task_id, row) for task_id, row, attempts in tasks if attempts < self._max_attempts]
+            self._conn.executemany('UPDATE tasks SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 '
+                                   'WHERE id = ?',
+                                   [(LEASED, worker, now + lease_seconds, task_id) for task_id, _ in live])
+        return [(task_id, json.loads(row)) for task_id, row in live]
+
+    def _complete(self, task_id, row):
+        self._conn.execute('UPDATE tasks SET state = ?, result = ? WHERE id = ? AND state != ?',
+                           (DONE, json.dumps(row), int(task_id), DONE))
+
+    def complete(self, results):
+        # results is a list of (task_id, row). A row whose lease expired is still accepted if nobody else has
+        # finished it yet.
+        with self._conn:
+            for task_id, row in results:
+                self._complete(task_id, row)
+
+    def release(self, worker):
+        # Puts a worker's unfinished tasks back in the queue, e.g. when it's shutting down.
+        with self._conn:
+            self._conn.execute('UPDATE tasks SET state = ?, attempts = attempts - 1 WHERE state = ? AND worker = ?',
+                               (PENDING, LEASED, worker))
+
+    def counts(self):
+        counts = dict(self._conn.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state'))
+        return {name: counts.get(state, 0) for name, state in [('pending', PENDING), ('leased', LEASED), ('done', DONE)]}
+
+    def finished_months(self):
+        # (month, output_fname, columns) for months whose tasks are all done but haven't been written out.
+        months = self._conn.execute('SELECT month, output_fname, columns FROM months WHERE NOT written AND NOT EXISTS '
+                                    '(SELECT 1 FROM tasks WHERE tasks.month = months.month AND state != ?)', (DONE,))
+        return [(month, output_fname, json.loads(columns)) for month, output_fname, columns in months]
+
+    def results(self, month):
+        for result, in self._conn.execute('SELECT result FROM tasks WHERE month = ? ORDER BY seq', (month,)):
+            yield json.loads(result)
+
+    def mark_written(self, month):
+        with self._conn:
+            self._conn.execute('UPDATE months SET written = 1 WHERE month = ?', (month,))
+
+    def all_written(self):
+        return self._conn.execute('SELECT 1 FROM months WHERE NOT written').fetchone() is None
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# distributed stage 2: fetches incidents handed out by coordinator.py and sends the scraped rows back
+
+import asyncio
+import os
+import socket
+import sys
+
+from aiohttp import ClientSession
+from aiohttp.client_exceptions import ClientConnectionError
+from argparse import ArgumentParser
+
+from async_utils import ordered_map
+from http_cache import cache_from_args
+from metrics import add_metrics_arguments, exporter_from_args
+from stage2 import add_session_arguments, fill_row, open_session
+
+# How long to wait before asking again when every remaining incident is leased to another worker.
+IDLE_WAIT = 5
+# How long to keep retrying while the coordinator is unreachable, e.g. while it's being restarted.
+UNREACHABLE_TIMEOUT = 120
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'coordinator_url',
+        metavar='URL',
+        help="coordinator.py's address, e.g. http://coordinator-host:8750",
+    )
+    parser.add_argument(
+        '-b', '--batch',
+        metavar='NUM',
+        help="lease NUM incidents from the coordinator at a time (default: 100)",
+        action='store',
+        dest='batch_size',
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        '-n', '--name',
+        metavar='NAME',
+        help="identify this worker to the coordinator as NAME (default: HOSTNAME:PID)",
+        action='store',
+        dest='name',
+        default='{}:{}'.format(socket.gethostname(), os.getpid()),
+    )
+    add_session_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    args.cache = cache_from_args(parser, args)
+    args.coordinator_url = args.coordinator_url.rstrip('/')
+    return args
+
+class CoordinatorClient(object):
+    def __init__(self, url, name):
+        self._url = url
+        self._name = name
+
+    async def __aenter__(self):
+        self._sess = await ClientSession().__aenter__()
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        await self._sess.__aexit__(type, value, tb)
+
+    async def _post(self, path, **body):
+        waited = 0
+        while True:
+            try:
+                async with self._sess.post(self._url + path, json=dict(body, worker=self._name)) as resp:
+                    resp.raise_for_status()
+                    return await resp.json()
+            except ClientConnectionError:
+                if waited >= UNREACHABLE_TIMEOUT:
+                    raise
+                print("Coordinator at {} is unreachable. Trying again in {}s...".format(self._url, IDLE_WAIT), file=sys.stderr)
+                await asyncio.sleep(IDLE_WAIT)
+                waited += IDLE_WAIT
+
+    async def lease(self, n):
+        # Returns a list of [task_id, row] and whether the coordinator is done. Waits while there's nothing to
+        # lease but other workers still have incidents out, since their leases may expire.
+        while True:
+            body = await self._post('/lease', n=n)
+            if body['tasks'] or body['done']:
+                return body['tasks']
+            await asyncio.sleep(IDLE_WAIT)
+
+    async def complete(self, results):
+        await self._post('/complete', results=results)
+
+    async def release(self):
+        await self._post('/release')
+
+async def work(args, coordinator, session):
+    async def process(task):
+        task_id, row = task
+        return task_id, await fill_row(session, row)
+
+    n_done = 0
+    tasks = await coordinator.lease(args.batch_size)
+    while tasks:
+        # Lease the next batch while this one is being fetched, so the connections don't go idle in between.
+        next_tasks = asyncio.ensure_future(coordinator.lease(args.batch_size))
+        try:
+            results = [result async for result in ordered_map(process, tasks, workers=args.conn_limit)]
+        except BaseException:
+            next_tasks.cancel()
+            raise
+        await coordinator.complete(results)
+        n_done += len(results)
+        print("Sent {} incidents to the coordinator".format(n_done), file=sys.stderr)
+        tasks = await next_tasks
+
+async def main():
+    args = parse_args()
+
+    async with exporter_from_args(args, 'worker'):
+        async with CoordinatorClient(args.coordinator_url, args.name) as coordinator:
+            try:
+                async with open_session(args) as session:
+                    await work(args, coordinator, session)
+            except BaseException:
+                # Hand our unfinished incidents to other workers now rather than when their leases expire.
+                try:
+                    await coordinator.release()
+                except Exception:
+                    pass
+                raise
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()